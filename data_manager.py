@@ -4,18 +4,431 @@ Data Manager for epidemic data
 """
 
 import os
-import sys
-import requests
-import urllib.request
+import logging
+import csv
+import glob
+import json
+import hashlib
 import re
 import urllib.parse
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 import datetime
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from instrumentation import Stats
+
+logger = logging.getLogger(__name__)
+
+# requests and matplotlib are imported by the methods using them: loading data from the local files does not pay for their import
+
+def file_fingerprint(path, withHash=True):
+    stat = os.stat(path)
+    fingerprint = {'size' : stat.st_size, 'mtime' : stat.st_mtime_ns}
+    if withHash:
+        fingerprint.update({'sha1' : file_hash(path)})
+    return fingerprint
+
+def file_hash(path, chunkSize=1 << 20):
+    sha = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for chunk in iter(lambda: infile.read(chunkSize), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+class DownloadError(Exception):
+    # A page or a file could not be downloaded, and no previous copy of it is available
+    pass
+
+class DataFetcher(object):
+    """
+    Download layer shared by HDXdata and POPdata
+    - A single requests session pools the connections, fetch_all downloads several files concurrently
+    - Files are streamed to disk in chunks, an interrupted download is resumed with a Range request
+    - ETag and Last-Modified of every file are kept in a .download_state.json file of its folder, unchanged files are not downloaded again
+    """
+    stateName = '.download_state.json'
+    
+    def __init__(self, workers=4, chunkSize=1 << 20, timeout=60):
+        self.workers = workers
+        self.chunkSize = chunkSize
+        self.timeout = timeout
+        import requests
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.stateLock = threading.Lock()
+        
+    def get(self, url, **kwargs):
+        return self.session.get(url, timeout=self.timeout, **kwargs)
+    
+    def state_path(self, path):
+        return os.path.join(os.path.dirname(os.path.abspath(path)), self.stateName)
+        
+    def read_state(self, path):
+        with self.stateLock:
+            return self.read_states(self.state_path(path)).get(os.path.basename(path))
+    
+    def read_states(self, statePath):
+        if not os.path.isfile(statePath):
+            return {}
+        try:
+            with open(statePath, 'r') as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return {}
+    
+    def write_state(self, path, fileState):
+        with self.stateLock:
+            statePath = self.state_path(path)
+            states = self.read_states(statePath)
+            states.update({os.path.basename(path) : fileState})
+            tmpPath = statePath + '.' + str(threading.get_ident()) + '.tmp'
+            with open(tmpPath, 'w') as outfile:
+                json.dump(states, outfile, indent=1)
+            os.replace(tmpPath, statePath)
+    
+    def fetch(self, url, path, beforeReplace=None):
+        """
+        Downloading url to path, through the file path + '.part'
+        beforeReplace(partPath, path) is called once the download is complete and before path is replaced;
+        if it fails, path is just replaced and the caches built on it are rebuilt at their next load
+        Returns 'downloaded', 'not-modified' or None if the download failed
+        """
+        from requests import RequestException
+        partPath = path + '.part'
+        fileState = self.read_state(path)
+        if fileState is not None and fileState.get('url') != url:
+            fileState = None
+        headers = {}
+        partial = fileState.get('partial') if fileState is not None else None
+        if partial is not None and os.path.isfile(partPath) and (partial.get('etag') or partial.get('lastModified')):
+            headers.update({'Range' : 'bytes=' + str(os.path.getsize(partPath)) + '-',
+                            'If-Range' : partial.get('etag') or partial.get('lastModified')})
+        elif fileState is not None and os.path.isfile(path):
+            if fileState.get('etag'):
+                headers.update({'If-None-Match' : fileState['etag']})
+            if fileState.get('lastModified'):
+                headers.update({'If-Modified-Since' : fileState['lastModified']})
+        logger.info("Downloading file " + os.path.basename(path) + " at URL " + url + " ...")
+        try:
+            with self.get(url, headers=headers, stream=True) as response:
+                if response.status_code == 304:
+                    logger.info("File " + os.path.basename(path) + " has not changed since its last download.")
+                    return 'not-modified'
+                restart = response.status_code == 416 and 'Range' in headers
+                if restart:
+                    # The part file is already complete, or longer than the file on the server: it cannot be resumed
+                    logger.warning("Download of file " + os.path.basename(path) + " cannot be resumed, it will be downloaded again")
+                    os.remove(partPath)
+                    self.write_state(path, {'url' : url, 'etag' : fileState.get('etag'), 'lastModified' : fileState.get('lastModified')})
+                elif not response.ok:
+                    logger.warning("Impossible to download file " + os.path.basename(path) + "! HTTP status " + str(response.status_code))
+                    return None
+                else:
+                    validators = {'etag' : response.headers.get('ETag'), 'lastModified' : response.headers.get('Last-Modified')}
+                    newState = {'url' : url, 'partial' : validators}
+                    if fileState is not None:
+                        newState.update({'etag' : fileState.get('etag'), 'lastModified' : fileState.get('lastModified')})
+                    self.write_state(path, newState)
+                    mode = 'ab' if response.status_code == 206 else 'wb'
+                    with open(partPath, mode) as outfile:
+                        for chunk in response.iter_content(chunk_size=self.chunkSize):
+                            outfile.write(chunk)
+        except (RequestException, OSError) as err:
+            logger.warning("Download of file " + os.path.basename(path) + " interrupted, it will be resumed at the next download: " + str(err))
+            return None
+        if restart:
+            return self.fetch(url, path, beforeReplace)
+        if beforeReplace is not None:
+            try:
+                beforeReplace(partPath, path)
+            except Exception as err:
+                logger.warning("Update of file " + os.path.basename(path) + " before its replacement failed, its caches will be rebuilt: " + repr(err))
+        os.replace(partPath, path)
+        self.write_state(path, dict({'url' : url}, **validators))
+        logger.info("File " + os.path.basename(path) + " has been successfuly downloaded and saved in " + os.path.dirname(os.path.abspath(path)) + ".")
+        return 'downloaded'
+    
+    def fetch_all(self, urls, paths, beforeReplace=None):
+        # Results are returned in the order of urls
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            return list(pool.map(lambda job: self.fetch(job[0], job[1], beforeReplace), zip(urls, paths)))
+
+sharedFetcher = None
+sharedFetcherLock = threading.Lock()
+
+def shared_fetcher():
+    # Created at the first download, which fetch_sources may start from several threads at once
+    global sharedFetcher
+    with sharedFetcherLock:
+        if sharedFetcher is None:
+            sharedFetcher = DataFetcher()
+        return sharedFetcher
+
+def fetch_sources(hdxData, popData, delta=False):
+    """
+    Downloading the HDX files and the WPP file at the same time
+    The data still have to be loaded afterwards, with HDXdata.load_parse_all_countries and POPdata.load
+    Returns the results of HDXdata.download and POPdata.download; raises DownloadError if a file is missing after the downloads
+    """
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        futures = [pool.submit(hdxData.download, delta), pool.submit(popData.download)]
+    return [future.result() for future in futures]
+
+def local_hdx_csvs(dataDir):
+    # HDX files already in dataDir, one per category, or an empty list if any is missing
+    paths = []
+    for category in TimeSeriesStore.categories:
+        found = sorted(glob.glob(os.path.join(dataDir, 'time_series*' + category + '*.csv')))
+        if len(found) == 0:
+            return []
+        paths.append(found[0])
+    return paths
+
+def read_sir_export(folder, table='sir_forecasts', columns=None, countries=None):
+    """
+    Reading back a table written by SIRmodelFITset.export_results: 'sir_params' or 'sir_forecasts'
+    Only the given columns are read, from the Parquet file if present, otherwise from the CSV file
+    With countries, only their rows are returned
+    """
+    if columns is not None and countries is not None and 'country' not in columns:
+        columns = ['country'] + list(columns)
+    parquetPath = os.path.join(folder, table + '.parquet')
+    if os.path.isfile(parquetPath):
+        filters = None if countries is None else [('country', 'in', list(countries))]
+        df = pd.read_parquet(parquetPath, columns=columns, filters=filters)
+    else:
+        csvPath = os.path.join(folder, table + '.csv')
+        dateColumns = [column for column in ['date', 'first_date', 'last_date'] if columns is None or column in columns]
+        header = pd.read_csv(csvPath, nrows=0).columns
+        df = pd.read_csv(csvPath, usecols=columns, parse_dates=[column for column in dateColumns if column in header])
+    if countries is not None:
+        df = df[df['country'].isin(countries)].reset_index(drop=True)
+    return df
+
+class HDXcache(object):
+    """
+    Binary cache of the parsed HDX csv files, stored next to them in the folder .hdx_cache
+    - The values of each csv are saved as a NumPy array, loaded memory-mapped
+    - The date axis and the region columns are saved in a json file, together with the size, mtime and sha1 of the source csv
+    """
+    keyColumns = ['Province/State', 'Country/Region', 'Lat', 'Long']
+    
+    def __init__(self, csvPath):
+        self.csvPath = csvPath
+        self.cacheDir = os.path.join(os.path.dirname(os.path.abspath(csvPath)), '.hdx_cache')
+        csvName = os.path.basename(csvPath)
+        self.valuesPath = os.path.join(self.cacheDir, csvName + '.npy')
+        self.metaPath = os.path.join(self.cacheDir, csvName + '.json')
+        
+    def read_meta(self):
+        if not os.path.isfile(self.metaPath) or not os.path.isfile(self.valuesPath):
+            return None
+        try:
+            with open(self.metaPath, 'r') as infile:
+                return json.load(infile)
+        except (OSError, ValueError):
+            return None
+        
+    def is_valid(self, meta):
+        if meta is None:
+            return False
+        stat = file_fingerprint(self.csvPath, withHash=False)
+        if stat['size'] == meta['source']['size'] and stat['mtime'] == meta['source']['mtime']:
+            return True
+        if stat['size'] != meta['source']['size']:
+            return False
+        # Same size but touched file: the content decides
+        if file_hash(self.csvPath) != meta['source']['sha1']:
+            return False
+        meta['source']['mtime'] = stat['mtime']
+        self.write_meta(meta)
+        return True
+    
+    def load(self):
+        # Returns the region columns, the date axis and the memory-mapped values, or None if the cache is not valid
+        meta = self.read_meta()
+        if not self.is_valid(meta):
+            return None
+        return meta['regions'], meta['dates'], np.load(self.valuesPath, mmap_mode='r')
+    
+    def save(self, regions, dates, values):
+        meta = {'source' : file_fingerprint(self.csvPath),
+                'dates' : list(dates),
+                'regions' : regions}
+        try:
+            os.makedirs(self.cacheDir, exist_ok=True)
+            tmpPath = self.valuesPath + '.tmp.npy'
+            np.save(tmpPath, values)
+            os.replace(tmpPath, self.valuesPath)
+            self.write_meta(meta)
+        except OSError as err:
+            logger.warning("Impossible to write cache for file " + self.csvPath + ": " + str(err))
+    
+    def extend(self, newCsvPath):
+        """
+        Appending to the cache the date columns that newCsvPath adds to the cached csv, without parsing it again
+        newCsvPath must keep the very same rows and values of the cached csv for the old dates, otherwise nothing is done
+        Returns the number of appended dates, or None if the cache has to be rebuilt
+        """
+        meta = self.read_meta()
+        if not self.is_valid(meta):
+            return None
+        nOld = len(self.keyColumns) + len(meta['dates'])
+        newValues = []
+        with open(self.csvPath, 'r', newline='') as oldFile, open(newCsvPath, 'r', newline='') as newFile:
+            oldReader, newReader = csv.reader(oldFile), csv.reader(newFile)
+            oldHeader, newHeader = next(oldReader, None), next(newReader, None)
+            if newHeader is None or len(newHeader) <= nOld or newHeader[0:nOld] != oldHeader:
+                return None
+            for oldRow, newRow in itertools.zip_longest(oldReader, newReader):
+                if oldRow is None or newRow is None or newRow[0:nOld] != oldRow:
+                    return None
+                newValues.append([float(val) if val != '' else np.nan for val in newRow[nOld:]])
+        values = np.load(self.valuesPath)
+        newValues = np.array(newValues, dtype=float).reshape(len(values), len(newHeader) - nOld)
+        if np.issubdtype(values.dtype, np.integer) and np.all(np.isfinite(newValues)) and np.all(newValues == np.round(newValues)):
+            newValues = newValues.astype(values.dtype)
+        meta['dates'] = meta['dates'] + newHeader[nOld:]
+        meta['source'] = file_fingerprint(newCsvPath)
+        tmpPath = self.valuesPath + '.tmp.npy'
+        np.save(tmpPath, np.hstack((values, newValues)))
+        os.replace(tmpPath, self.valuesPath)
+        self.write_meta(meta)
+        return newValues.shape[1]
+    
+    def write_meta(self, meta):
+        tmpPath = self.metaPath + '.tmp'
+        with open(tmpPath, 'w') as outfile:
+            json.dump(meta, outfile)
+        os.replace(tmpPath, self.metaPath)
+
+class TimeSeriesStore(object):
+    """
+    Compact store of the HDX time series: one contiguous integer array shaped [region, category, day]
+    - All the categories share one date axis, the dates present in the files of every category, and the same region index
+    - A region missing in the file of a category has zero values, and is flagged in the present mask
+    - Country totals are a second array shaped [country, category, day], obtained by one grouped reduction of the regions
+    Series and per-country data are views of these arrays, no values are copied
+    """
+    categories = ['confirmed', 'deaths', 'recovered']
+    
+    def __init__(self, tables):
+        # tables: category -> (region columns, date axis, values), as read from a csv or from its cache
+        regionIndex = {}
+        lat, long = [], []
+        for category in self.categories:
+            regions = tables[category][0]
+            for province, country, latitude, longitude in zip(*(regions[key] for key in HDXcache.keyColumns)):
+                key = (self.clean_province(province), country)
+                if key not in regionIndex:
+                    regionIndex[key] = len(regionIndex)
+                    lat.append(latitude)
+                    long.append(longitude)
+        self.regionIndex = regionIndex
+        self.regions = list(regionIndex.keys())
+        self.lat = np.array(lat, dtype=float)
+        self.long = np.array(long, dtype=float)
+        # A date missing from a file has no values for its category: it is dropped from all the categories rather than filled with zeros
+        dates = pd.Index(tables['confirmed'][1])
+        shared = np.ones(len(dates), dtype=bool)
+        for category in self.categories:
+            shared &= dates.isin(tables[category][1])
+        if not shared.all():
+            logger.warning("Dates " + ', '.join(dates[~shared]) + " are not in the files of every category, they are ignored")
+        self.dates = dates[shared]
+        
+        maxValue = max((np.nanmax(table[2]) if np.size(table[2]) > 0 else 0) for table in tables.values())
+        dtype = np.int32 if maxValue < np.iinfo(np.int32).max else np.int64
+        self.values = np.zeros((len(self.regions), len(self.categories), len(self.dates)), dtype=dtype)
+        self.present = np.zeros((len(self.regions), len(self.categories)), dtype=bool)
+        for idxCategory, category in enumerate(self.categories):
+            regions, dates, values = tables[category]
+            rows = np.array([regionIndex[(self.clean_province(province), country)] for province, country in zip(regions['Province/State'], regions['Country/Region'])], dtype=np.intp)
+            # Columns of the file on the shared date axis, the other dates of the file are dropped
+            columns = self.dates.get_indexer(dates)
+            found = columns >= 0
+            self.values[rows[:, None], idxCategory, columns[found]] = np.nan_to_num(np.asarray(values)[:, found])
+            self.present[rows, idxCategory] = True
+        
+        # Country of each region, then one reduction over the regions sorted by country
+        countryNames = [country for province, country in self.regions]
+        self.countries = list(dict.fromkeys(countryNames))
+        self.countryIndex = {country : idx for idx, country in enumerate(self.countries)}
+        self.regionCountry = np.array([self.countryIndex[country] for country in countryNames], dtype=np.intp)
+        order = np.argsort(self.regionCountry, kind='stable')
+        starts = np.flatnonzero(np.r_[True, np.diff(self.regionCountry[order]) != 0])
+        self.countryRegions = np.split(order, starts[1:])
+        if len(self.regions) > 0:
+            self.totals = np.add.reduceat(self.values[order], starts, axis=0)
+            self.totalsPresent = np.logical_or.reduceat(self.present[order], starts, axis=0)
+        else:
+            self.totals = np.zeros((0,) + self.values.shape[1:], dtype=dtype)
+            self.totalsPresent = np.zeros((0, len(self.categories)), dtype=bool)
+        
+    def clean_province(self, province):
+        return '' if not isinstance(province, str) else province
+    
+    def region_name(self, idxRegion):
+        province, country = self.regions[idxRegion]
+        return country if province == '' else province + ', ' + country
+    
+    def region_names(self):
+        return [self.region_name(idxRegion) for idxRegion in range(len(self.regions))]
+    
+    def series(self, values, name):
+        return pd.Series(values, index=self.dates, name=name, copy=False)
+        
+    def country_view(self, country, aggregate=False):
+        """
+        Values [category, day] of a country, None if the country is not in the store
+        With aggregate, the country total; otherwise its first region present in each category
+        """
+        idxCountry = self.countryIndex.get(country)
+        if idxCountry is None:
+            return None
+        if aggregate:
+            return CountryTimeSeries(country, self.totals[idxCountry], self.dates, self.totalsPresent[idxCountry])
+        regions = self.countryRegions[idxCountry]
+        present = self.present[regions]
+        first = [regions[np.argmax(present[:, idxCategory])] for idxCategory in range(len(self.categories))]
+        if all(idxRegion == first[0] for idxRegion in first):
+            # Common case: one region holds all the categories, the view is a slice of the store
+            values = self.values[first[0]]
+        else:
+            values = np.stack([self.values[idxRegion, idxCategory] for idxCategory, idxRegion in enumerate(first)])
+        return CountryTimeSeries(country, values, self.dates, present.any(axis=0))
+    
+    def category_series(self, category, aggregate=False):
+        # One series per region, or per country with aggregate, present in the category
+        idxCategory = self.categories.index(category)
+        if aggregate:
+            return {country : self.series(self.totals[idxCountry, idxCategory], country) for idxCountry, country in enumerate(self.countries) if self.totalsPresent[idxCountry, idxCategory]}
+        return {self.region_name(idxRegion) : self.series(self.values[idxRegion, idxCategory], self.region_name(idxRegion)) for idxRegion in np.flatnonzero(self.present[:, idxCategory])}
+    
+    def nbytes(self):
+        return self.values.nbytes + self.totals.nbytes
+
+class CountryTimeSeries(object):
+    """
+    Values of a country as given by TimeSeriesStore.country_view: an array [category, day] with the date axis of the store
+    """
+    def __init__(self, countryName, values, dates, present):
+        self.countryName = countryName
+        self.values = values
+        self.dates = dates
+        self.present = present
+        
+    def __len__(self):
+        return int(np.count_nonzero(self.present))
 
 class HDXdata(object):
-    def __init__(self, csvPaths=[]):
+    url = "https://data.humdata.org/dataset/novel-coronavirus-2019-ncov-cases"
+    
+    def __init__(self, csvPaths=[], useCache=True, url=None, dataDir=None, fetcher=None, aggregate=False):
         if not csvPaths == []:
             self.csvNames = [os.path.basename(f) for f in csvPaths]
             self.csvPaths = csvPaths
@@ -25,6 +438,21 @@ class HDXdata(object):
         self.countriesNames = []
         self.countriesData = {}
         self.countriesDataParsed = {}
+        self.store = None
+        # With aggregate, countries split in provinces are loaded as the sum of their provinces instead of their first row
+        self.aggregate = aggregate
+        self.useCache = useCache
+        self.stats = Stats()
+        if url is not None:
+            self.url = url
+        self.dataDir = dataDir if dataDir is not None else os.getcwd()
+        # Without a given fetcher, the shared one is taken at the first download: loading local files does not import requests
+        self.fetcher = fetcher
+        
+    def get_fetcher(self):
+        if self.fetcher is None:
+            self.fetcher = shared_fetcher()
+        return self.fetcher
         
     def set_countries(self, countriesNames):
         self.countriesNames = countriesNames
@@ -60,11 +488,11 @@ class HDXdata(object):
     
     def get_country_category(self, country='', category=''):
         if country == '' or not country in self.countriesDataParsed.keys():
-            print("ERROR: No valid specified country '" + country + "' !")
+            logger.error("No valid specified country '" + country + "' !")
         else:
             if not category in ['confirmed', 'deaths', 'recovered']:
-                print("ERROR: Specified category '" + category + "' for country '" + country + "' is invalid!")
-            return self.countriesDataParsed[country].allData[category].drop(columns=['Province/State', 'Country/Region', 'Lat', 'Long']).iloc[0]
+                logger.error("Specified category '" + category + "' for country '" + country + "' is invalid!")
+            return self.countriesDataParsed[country].allValues[category]
     
     def get_countries_confirmed(self):
         return self.get_countries_category('confirmed')
@@ -81,9 +509,43 @@ class HDXdata(object):
             countries_df.update({country : self.get_country_category(country, category)})
         return countries_df
     
+    def search_csvName(self, category):
+        if not category in TimeSeriesStore.categories:
+            logger.error("Specified category '" + category + "' is invalid!")
+            return None
+        return [csvName for csvName in self.csvNames if category in csvName.lower()][0]
+    
+    def get_store(self):
+        self.load_csvs()
+        return self.store
+    
+    def get_all_countries_category(self, category=''):
+        """
+        Time series of every country of the dataset, provinces being summed to their country
+        Returns a dictionary country -> series of values indexed by dates
+        """
+        if not category in TimeSeriesStore.categories:
+            logger.error("Specified category '" + category + "' is invalid!")
+            return {}
+        return self.get_store().category_series(category, aggregate=True)
+    
+    def get_regions_names(self):
+        return self.get_store().region_names()
+    
+    def get_regions_category(self, category=''):
+        """
+        Time series of every region of the dataset: a whole country or one of its provinces
+        Regions are named as the country, or as 'Province, Country' for provinces; their populations are given by POPdata.get_pop_regions
+        Returns a dictionary region -> series of values indexed by dates
+        """
+        if not category in TimeSeriesStore.categories:
+            logger.error("Specified category '" + category + "' is invalid!")
+            return {}
+        return self.get_store().category_series(category)
+    
     def add_countriesNames(self, *countriesNames):
         if countriesNames=="":
-            print('No countriesNames to add...')
+            logger.info('No countriesNames to add...')
             pass
         for idxCountry, country in enumerate(countriesNames):
             if country not in self.countriesNames:
@@ -93,130 +555,182 @@ class HDXdata(object):
         if self.countriesData == {} or countryName not in self.countriesData.keys():
             self.countriesData.update({countryName : countryData})
         else:
-            print("WARNING: Country '" + countryName + "' is present in data and will be replaced")
+            logger.warning("Country '" + countryName + "' is present in data and will be replaced")
             self.countriesData[countryName] = countryData
     
-    def download(self):
+    def download(self, delta=False):
+        """
+        Downloading the csv files linked in the HDX page to dataDir
+        - Files are downloaded concurrently by the DataFetcher, unchanged files are not downloaded again
+        - With delta=True, a file that only adds dates to its previous version has just the new dates appended to its cache
+        Returns the results of DataFetcher.fetch for every file
+        Raises DownloadError if the page cannot be fetched, or if a file could not be downloaded and has no previous copy
+        """
+        from requests import RequestException
         # Fetching data
-        url = "https://data.humdata.org/dataset/novel-coronavirus-2019-ncov-cases"
-        print("Loading webpage from " + repr(url) + " ...")
-        response = requests.get(url)
+        url = self.url
+        logger.info("Loading webpage from " + repr(url) + " ...")
+        try:
+            response = self.get_fetcher().get(url)
+        except RequestException as err:
+            raise DownloadError("Impossible to fetch data from the URL " + url + ": " + str(err))
         if not response.ok :
-            print("ERROR: Impossible to fetch data from the URL! The script will abort ...")
-            sys.exit()
-        print('Data has been correctly loaded.\n')
+            raise DownloadError("Impossible to fetch data from the URL " + url + "! HTTP status " + str(response.status_code))
+        logger.info('Data has been correctly loaded.\n')
         
         # Parsing website's content by regex
         self.csvNames = re.findall(r'<span class="ga-download-resource-title" style="display: none">(.*)</span>', response.text)[0:3]
-        print('The following data-sets have been found:\n' + '\n'.join(map(str, self.csvNames)) + '\n')
+        logger.info('The following data-sets have been found:\n' + '\n'.join(map(str, self.csvNames)) + '\n')
         
         csvLinks = list(map(urllib.parse.unquote, re.findall('<a href="\S+(?<=url=)(.*)"(?=\sclass)', response.text)[0:3] ))
         fixLink = lambda x: re.sub(r'&amp;.*', "", x)
         csvLinks = list(map(fixLink, csvLinks))
         
-        # Downloading files from extracted URLs - To the actual directory
-        os.chdir( os.getcwd() )
-        def downloadFile(url, filename='None'):
-            if filename=='None':
-                filename = url.split('/')[-1]
-            print("Downloading file " + filename + " at URL " + url + " ...")
-            urllib.request.urlretrieve(url, filename)
-            if os.path.isfile(filename):
-                print("File " + filename + " has been successfuly downloaded and saved in " + os.getcwd() + ".")
-            else:
-                print("WARNING: Impossible to download file " + filename + "!")
-            print('\n')
-
-        for idxFile in range(len(csvLinks)):
-            downloadFile(csvLinks[idxFile], self.csvNames[idxFile])
+        # Downloading files from extracted URLs - To the data directory, all at once
+        paths = [os.path.join(self.dataDir, s) for s in self.csvNames]
+        if len(paths) == 0:
+            raise DownloadError("No csv file is linked in the page at URL " + url)
+        with self.stats.timer('download'):
+            results = self.get_fetcher().fetch_all(csvLinks, paths, self.extend_cache if delta else None)
+        missing = [os.path.basename(path) for path, result in zip(paths, results) if result is None and not os.path.isfile(path)]
+        if len(missing) > 0:
+            raise DownloadError("Impossible to download files " + ', '.join(missing))
         
-        self.csvPaths = [os.getcwd() + '\\' + s for s in self.csvNames]
+        self.csvPaths = paths
+        self.reset_index()
+        return results
         
-    def load_country(self, country=None):
+    def extend_cache(self, partPath, path):
+        if os.path.isfile(path):
+            nNewDates = HDXcache(path).extend(partPath)
+            if nNewDates is not None:
+                logger.info(str(nNewDates) + " new dates of file " + os.path.basename(path) + " have been appended to its cache.")
+        
+    def reset_index(self):
+        self.store = None
+        
+    def load_csvs(self):
+        # Every csv file is parsed only once, into the store shared by all the countries
+        if self.store is not None:
+            return
         if self.csvPaths==[]:
-            print("No available data. Downloading them...")
+            logger.info("No available data. Downloading them...")
             self.download()
+        tables = {}
+        for category in TimeSeriesStore.categories:
+            csvName = self.search_csvName(category)
+            tables.update({category : self.read_csv(self.csvPaths[self.csvNames.index(csvName)])})
+        with self.stats.timer('build_store'):
+            self.store = TimeSeriesStore(tables)
+        
+    def read_csv(self, csvPath):
+        # Returns the region columns, the date axis and the values of a csv file
+        if self.useCache:
+            cache = HDXcache(csvPath)
+            with self.stats.timer('cache_load'):
+                table = cache.load()
+            if table is not None:
+                self.stats.count('cache_hits')
+                return table
+            self.stats.count('cache_misses')
+        with self.stats.timer('csv_parse'):
+            df = pd.read_csv(csvPath)
+        self.stats.count('csv_parses')
+        regions = df[HDXcache.keyColumns].to_dict('list')
+        values = df.drop(columns=HDXcache.keyColumns)
+        numeric = all(pd.api.types.is_numeric_dtype(dtype) for dtype in values.dtypes)
+        if not numeric:
+            logger.warning("Non-numeric values in file " + csvPath + ", its data will not be cached")
+            values = values.apply(pd.to_numeric, errors='coerce')
+        table = (regions, list(values.columns), values.to_numpy())
+        if self.useCache and numeric:
+            cache.save(*table)
+        return table
+        
+    def load_country(self, country=None):
         if country==None:
-            print("WARNING: No country to load has been specified, no data will be returned")
+            logger.warning("No country to load has been specified, no data will be returned")
             pass
-        country_df = {}
-        for idxSrc, csvAct in enumerate(self.csvPaths):
-            df = pd.read_csv(csvAct)
-            if df['Country/Region'].isin([country]).any():
-                country_df.update({self.csvNames[idxSrc] : df[df['Country/Region'] == country]})
-                self.add_countriesNames(country)
-            else:
-                print("WARNING: No country named '" + country + "' could be found in dataset named " + self.csvNames[idxSrc] )
-        self.replace_countryData(country, country_df)
-        return country_df
+        countryView = self.get_store().country_view(country, self.aggregate)
+        if countryView is None:
+            logger.warning("No country named '" + str(country) + "' could be found in dataset")
+            return None
+        for idxCategory, category in enumerate(TimeSeriesStore.categories):
+            if not countryView.present[idxCategory]:
+                logger.warning("No country named '" + country + "' could be found in dataset named " + self.search_csvName(category))
+        self.add_countriesNames(country)
+        self.replace_countryData(country, countryView)
+        return countryView
     
     def load_all_countries(self):
         if len(self.countriesNames)==0:
-            print("ERROR: No countriesNames are defined!")
+            logger.error("No countriesNames are defined!")
             pass
-        for country in self.countriesNames:
-            print("Loading data for country '" + country + "' ...")
-            self.countriesData.update({country : self.load_country(country)})
+        with self.stats.timer('load_countries'):
+            for country in self.countriesNames:
+                logger.debug("Loading data for country '%s' ...", country)
+                self.countriesData.update({country : self.load_country(country)})
             
     def parse_country(self, country):
         return ParsedDataCountry( self.get_countryData(country) )
             
     def parse_all_countries(self):
         if len(self.countriesNames)==0:
-            print("ERROR: No countriesNames are defined!")
+            logger.error("No countriesNames are defined!")
             pass
-        for country in self.countriesNames:
-            print("Parsing data for country '" + country + "' ...")
-            self.countriesDataParsed.update({country : self.parse_country(country)})
+        with self.stats.timer('parse_countries'):
+            for country in self.countriesNames:
+                logger.debug("Parsing data for country '%s' ...", country)
+                self.countriesDataParsed.update({country : self.parse_country(country)})
             
     def load_parse_all_countries(self):
         self.load_all_countries()
         self.parse_all_countries()
         
-    def refresh(self):
-        print("Refreshing available data ...")
-        self.download()
+    def refresh(self, delta=False):
+        logger.info("Refreshing available data ...")
+        self.download(delta)
         self.load_parse_all_countries()
 
 class ParsedDataCountry(object):
-    def __init__(self, countryData=0):
-        if not len(countryData) == 0:
-            self.confirmed = self.search_category(countryData, 'confirmed')
-            self.deaths = self.search_category(countryData, 'deaths')
-            self.recovered = self.search_category(countryData, 'recovered')
-            self.allData = { 'confirmed' : self.confirmed , 'deaths' : self.deaths , 'recovered' : self.recovered }
-            self.countryName = self.extract_countryName()
+    """
+    Series of a country, built on the values [category, day] given by HDXdata.get_countryData
+    The series are views of the store of HDXdata, sharing its date axis
+    """
+    def __init__(self, countryData=None):
+        if countryData is not None and not len(countryData) == 0:
+            self.values = countryData.values
+            self.dates = countryData.dates
+            self.countryName = countryData.countryName
+            self.allValues = { category : pd.Series(self.values[idxCategory], index=self.dates, name=category, copy=False) for idxCategory, category in enumerate(TimeSeriesStore.categories) }
+            self.allData = self.allValues
+            self.confirmed = self.allValues['confirmed']
+            self.deaths = self.allValues['deaths']
+            self.recovered = self.allValues['recovered']
             self.timeData = self.extract_time()
         else:
             self.confirmed = []
             self.deaths = []
             self.recovered = []
             self.countryName = []
-    
-    def search_category(self, dictionary, search_key):
-        return [val for key, val in dictionary.items() if search_key in key.lower()][0]
-
-    def extract_countryName(self):
-        for key, currentData in self.allData.items():
-            if not len(currentData) == 0:
-                return currentData["Country/Region"].to_string(index=False).strip()
+            self.allData = {}
+            self.allValues = {}
             
     def extract_time(self):
-        for key, currentData in self.allData.items():
-            if not len(currentData) == 0:
-                return currentData.columns[4:-1]
+        return self.dates[0:-1]
             
     def get_values_category(self, category):
         if category == '' or category not in self.allData.keys():
-            print("ERROR: Specified category " + category + " is invalid or not present in data!")
+            logger.error("Specified category " + category + " is invalid or not present in data!")
         else:
-            return self.allData[category][self.timeData].iloc[0]
-            #return data.head(), data.iloc[0]
+            return self.allData[category].iloc[0:len(self.timeData)]
         
     def plot_values_category(self, category):
         if category == '' or category not in self.allData.keys():
-            print("ERROR: Specified category '" + category + "' is invalid or not present in data!")
+            logger.error("Specified category '" + category + "' is invalid or not present in data!")
         else:
+            import matplotlib.pyplot as plt
+            import matplotlib.ticker as ticker
             data = self.get_values_category(category)
             fig = plt.figure()
             ax = plt.subplot(111)
@@ -231,6 +745,8 @@ class ParsedDataCountry(object):
             return fig, ax
         
     def plot_values(self, dpi=300):
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as ticker
         categories = self.allData.keys()
         fig = plt.figure()
         ax = plt.subplot(111)
@@ -247,50 +763,155 @@ class ParsedDataCountry(object):
         fig.set_dpi(dpi)
 
 class POPdata(object):
-    def __init__(self, force_update=False):
-        url = 'https://population.un.org/wpp/Download/Files/1_Indicators%20(Standard)/CSV_FILES/WPP2019_TotalPopulationBySex.csv'
-        filename = url.split('/')[-1]
-        self.filepath = os.getcwd() + '\\' + filename
-        if not os.path.isfile(filename) or force_update:
-            print("Downloading populations' file " + filename + " at URL " + url + " ...")
-            res = requests.get(url)
-            with open(filename, 'wb') as outfile:
-                outfile.write(res.content)
+    countriesRemap = {
+        'US' : 'United States of America'
+        }
+    
+    url = 'https://population.un.org/wpp/Download/Files/1_Indicators%20(Standard)/CSV_FILES/WPP2019_TotalPopulationBySex.csv'
+    
+    def __init__(self, force_update=False, variant='Medium', url=None, dataDir=None, fetcher=None, load=True):
+        if url is not None:
+            self.url = url
+        filename = self.url.split('/')[-1]
+        self.filepath = os.path.join(dataDir if dataDir is not None else os.getcwd(), filename)
+        self.indexPath = self.filepath + '.idx.npz'
+        self.variant = variant
+        # Without a given fetcher, the shared one is taken at the first download
+        self.fetcher = fetcher
+        self.popIndex = {}
+        if load:
+            self.load(force_update)
+        
+    def get_fetcher(self):
+        if self.fetcher is None:
+            self.fetcher = shared_fetcher()
+        return self.fetcher
+        
+    def download(self):
+        """
+        Downloading the WPP file, returns the result of DataFetcher.fetch
+        Raises DownloadError if the file could not be downloaded and has no previous copy
+        """
+        logger.info("Downloading populations' file " + os.path.basename(self.filepath) + " at URL " + self.url + " ...")
+        result = self.get_fetcher().fetch(self.url, self.filepath)
+        if result is None:
+            if not os.path.isfile(self.filepath):
+                raise DownloadError("Impossible to download populations' file " + os.path.basename(self.filepath) + " !")
+            logger.error("Impossible to download populations' file " + os.path.basename(self.filepath) + ", the previous one is used")
+        return result
+        
+    def load(self, force_update=False):
+        if force_update:
+            self.download()
+        if self.load_index():
+            logger.info("Using populations' index " + self.indexPath + '\n')
+            return
+        if not os.path.isfile(self.filepath):
+            self.download()
         else:
-            print("Using already existing file " + self.filepath + " to extract the populations' data" + '\n')
-        self.allPopData = self.parseData()
+            logger.info("Using already existing file " + self.filepath + " to extract the populations' data" + '\n')
+        self.popIndex = self.parseData()
+        self.save_index()
 
     def parseData(self):
+        # Streaming the csv, only the populations of the selected variant are kept
         if not os.path.isfile(self.filepath):
-            print("ERROR: Cannot find file " + self.path + " ! No data will be extracted.")
-            return []
-        df = pd.read_csv(self.filepath, usecols=["Location", "Time", "PopTotal"], index_col="Location")
-        #cols = df.columns
-        #colToRename = [el for idx, el in enumerate(cols) if 'Year_' in el]
-        #df.rename(columns=lambda s: s.replace("Year_", ""), inplace=True)
-        return df
+            logger.error("Cannot find file " + self.filepath + " ! No data will be extracted.")
+            return {}
+        pops = {}
+        with open(self.filepath, 'r', newline='', encoding='utf-8') as infile:
+            for row in csv.DictReader(infile):
+                if row['Variant'] != self.variant:
+                    continue
+                pops.setdefault(row['Location'], {}).update({int(row['Time']) : float(row['PopTotal']) * 1000})
+        popIndex = {}
+        for location, popYears in pops.items():
+            firstYear = min(popYears.keys())
+            popArray = np.full(max(popYears.keys()) - firstYear + 1, np.nan)
+            for year, pop in popYears.items():
+                popArray[year - firstYear] = pop
+            popIndex.update({location : (firstYear, popArray)})
+        for country, location in self.countriesRemap.items():
+            if location in popIndex.keys():
+                popIndex.update({country : popIndex[location]})
+        return popIndex
+    
+    def load_index(self):
+        if not os.path.isfile(self.indexPath):
+            return False
+        try:
+            with np.load(self.indexPath) as index:
+                if str(index['variant']) != self.variant:
+                    return False
+                if os.path.isfile(self.filepath):
+                    stat = file_fingerprint(self.filepath, withHash=False)
+                    if stat['size'] != int(index['size']) or stat['mtime'] != int(index['mtime']):
+                        return False
+                offsets = index['offsets']
+                self.popIndex = {str(location) : (int(index['firstYears'][idx]), index['pops'][offsets[idx]:offsets[idx + 1]])
+                                 for idx, location in enumerate(index['locations'])}
+        except (OSError, KeyError, ValueError):
+            return False
+        return True
+    
+    def save_index(self):
+        if len(self.popIndex) == 0:
+            return
+        locations = list(self.popIndex.keys())
+        popArrays = [self.popIndex[location][1] for location in locations]
+        stat = file_fingerprint(self.filepath, withHash=False)
+        try:
+            np.savez(self.indexPath, locations=np.array(locations), variant=np.array(self.variant),
+                     firstYears=np.array([self.popIndex[location][0] for location in locations], dtype=np.int16),
+                     offsets=np.cumsum([0] + [len(pops) for pops in popArrays]),
+                     pops=np.concatenate(popArrays), size=stat['size'], mtime=stat['mtime'])
+        except OSError as err:
+            logger.warning("Impossible to write populations' index " + self.indexPath + ": " + str(err))
 
     def get_pop_country(self, country='', year=datetime.datetime.now().year):
         if country == '':
-            print("ERROR: No specified country to extract data from!")
+            logger.error("No specified country to extract data from!")
+            return []
+        if len(self.popIndex) == 0:
+            logger.error("Invalid populations' data!")
+            return []
+        if not country in self.popIndex.keys():
+            logger.error("No population available for country '" + country + "' !")
             return []
-        if self.allPopData.empty == True:
-            print("ERROR: Invalid populations' data!")
+        firstYear, popArray = self.popIndex[country]
+        if year < firstYear or year - firstYear >= len(popArray):
+            logger.error("No population available for country '" + country + "' in year " + str(year) + " !")
             return []
-        countryData = self.allPopData.loc[self.remap_country_name(country)].set_index("Time")
-        return countryData.loc[year].iloc[0][0] * 1000
+        return float(popArray[year - firstYear])
     
     def remap_country_name(self, country):
-        switcher = {
-            'US' : 'United States of America'
-            }
-        return switcher.get(country, country)
+        return self.countriesRemap.get(country, country)
 
     def get_pop_countries(self, *countriesNames):
         if countriesNames=="":
-            print('No countriesNames to get the popolation for...')
+            logger.info('No countriesNames to get the popolation for...')
             pass
         pops = {}
         for country in countriesNames:
             pops.update({country : self.get_pop_country(country)})
+        return pops
+    
+    def get_pop_regions(self, regionsNames, regionsPops=None, year=datetime.datetime.now().year):
+        """
+        Populations of the regions of HDXdata.get_regions_category, named as the country or as 'Province, Country'
+        The WPP file only has the populations of whole countries: provinces take theirs from regionsPops, a dictionary region -> population
+        Regions with no known population get [] as in get_pop_country, SIRmodelFITset reports them in fitErrors without fitting them
+        """
+        regionsPops = regionsPops if regionsPops is not None else {}
+        pops, missing = {}, []
+        for region in regionsNames:
+            if region in regionsPops:
+                pops.update({region : float(regionsPops[region])})
+            elif region in self.popIndex.keys():
+                pops.update({region : self.get_pop_country(region, year)})
+            else:
+                pops.update({region : []})
+                missing.append(region)
+        if len(missing) > 0:
+            logger.warning("No population available for " + str(len(missing)) + " regions: " + ', '.join(missing))
         return pops
\ No newline at end of file
@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+"""
+Local HTTP service answering forecasts and fitted parameters in JSON
+- HDXdata, POPdata and the fitted SIRmodelFIT of every asked country stay in memory between requests
+- A country is fitted at its first request, reusing the parameters of the fit store when its data did not change
+- Requests are served by threads: each country has its own lock, so a fit only delays the requests of its country
+- A refresh downloads the data again and swaps them in; countries are refitted lazily, at their next request, starting from their last fit
+
+Endpoints:
+    GET  /countries                                      countries available in the data
+    GET  /params?country=Italy                           fitted parameters of a country
+    GET  /forecast?country=Italy&days=20&quantiles=0.05,0.95
+    GET  /compare?countries=Spain,France&days=20         forecasts of several countries
+    POST /refresh?delta=1                                download the data again
+
+Example: python forecast_service.py --port 8000, then http://127.0.0.1:8000/forecast?country=Italy&days=20
+"""
+
+import os
+import json
+import logging
+import argparse
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import data_manager as dtmg
+import lib_sir_model as sir
+import instrumentation
+
+logger = logging.getLogger(__name__)
+
+class ForecastService(object):
+    def __init__(self, dataDir=None, storePath='sir_fits.json', aggregate=False, IC=None, url=None):
+        self.dataDir = dataDir if dataDir is not None else os.getcwd()
+        self.aggregate = aggregate
+        self.IC = IC
+        self.fitStore = sir.SIRfitStore(storePath)
+        self.storeLock = threading.Lock()
+        self.models = {}
+        self.countryLocks = {}
+        self.locksLock = threading.Lock()
+        # data and generation are replaced together by refresh, requests read them once
+        self.dataLock = threading.Lock()
+        self.refreshLock = threading.Lock()
+        self.generation = 0
+        csvPaths = dtmg.local_hdx_csvs(self.dataDir)
+        # url is the HDX page, the default one if None: refreshes download from it too
+        data = dtmg.HDXdata(csvPaths, url=url, dataDir=self.dataDir, aggregate=aggregate)
+        self.popData = dtmg.POPdata(dataDir=self.dataDir, load=False)
+        if len(csvPaths) == 0:
+            dtmg.fetch_sources(data, self.popData)
+        self.popData.load()
+        data.load_csvs()
+        self.data = data
+
+    def snapshot(self):
+        with self.dataLock:
+            return self.data, self.generation
+
+    def country_lock(self, country):
+        with self.locksLock:
+            if country not in self.countryLocks:
+                self.countryLocks.update({country : threading.Lock()})
+            return self.countryLocks[country]
+
+    def get_countries(self):
+        data, generation = self.snapshot()
+        return data.get_store().countries
+
+    def get_model(self, country):
+        """
+        Fitted model of a country for the current data, fitted now if needed
+        Raises KeyError if the country is not in the data
+        """
+        with self.country_lock(country):
+            data, generation = self.snapshot()
+            cached = self.models.get(country)
+            if cached is not None and cached[0] == generation:
+                return cached[1]
+            countryView = data.get_store().country_view(country, self.aggregate)
+            if countryView is None:
+                raise KeyError(country)
+            confirmed = dtmg.ParsedDataCountry(countryView).allValues['confirmed']
+            model = sir.SIRmodelFIT({country : confirmed}, {country : self.popData.get_pop_country(country)}, country)
+            fingerprint = model.fingerprint()
+            with self.storeLock:
+                storedFit = self.fitStore.get(country)
+            if storedFit is not None and storedFit['fingerprint'] == fingerprint:
+                model.set_params(storedFit['params'], storedFit.get('cov'))
+            else:
+                # Changed data start from the last fit of the country, in memory or in the store
+                if cached is not None and cached[1].params is not None:
+                    warmParams = cached[1].params
+                else:
+                    warmParams = None if storedFit is None else storedFit['params']
+                logger.info("Fitting country '" + country + "' on data generation " + str(generation))
+                sir.fit_params(model, self.IC, warmParams)
+                with self.storeLock:
+                    self.fitStore.update(country, fingerprint, model.params, model.paramsCov)
+                    self.fitStore.save()
+            self.models.update({country : (generation, model)})
+            return model
+
+    def params(self, country):
+        model = self.get_model(country)
+        return {'country' : country,
+                'beta' : float(model.params[0]),
+                'gamma' : float(model.params[1]),
+                'cov' : None if model.paramsCov is None else model.paramsCov.tolist(),
+                'population' : float(model.pop),
+                'last_date' : model.tDate[-1]}
+
+    def forecast(self, country, nDays=20, quantiles=(), nDraws=1000):
+        model = self.get_model(country)
+        dates, prediction, bands = model.forecast(nDays, quantiles, nDraws)
+        res = {'country' : country, 'dates' : list(dates), 'infected' : prediction.tolist()}
+        if bands is not None:
+            res.update({'quantiles' : {'%g' % quantile : band.tolist() for quantile, band in zip(quantiles, bands)}})
+        return res
+
+    def refresh(self, delta=False):
+        """
+        Downloading and loading the data again, then swapping them in: requests keep being served from the previous data meanwhile
+        Models are not refitted here, but at the next request of their country
+        Raises DownloadError if a file could not be downloaded: the previous data are kept
+        """
+        with self.refreshLock:
+            previous, generation = self.snapshot()
+            data = dtmg.HDXdata(url=previous.url, dataDir=self.dataDir, fetcher=previous.fetcher, aggregate=self.aggregate)
+            try:
+                results = data.download(delta)
+                if None in results:
+                    raise dtmg.DownloadError("Some files could not be downloaded again")
+            except dtmg.DownloadError as err:
+                logger.error("Refresh failed, serving the data of generation " + str(generation) + ": " + str(err))
+                raise
+            data.load_csvs()
+            with self.dataLock:
+                self.data = data
+                self.generation += 1
+                return self.generation
+
+class ForecastRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        service = self.server.service
+        try:
+            if url.path == '/countries':
+                self.send_json(200, service.get_countries())
+            elif url.path == '/params':
+                self.send_json(200, service.params(self.get_arg(query, 'country')))
+            elif url.path == '/forecast':
+                self.send_json(200, service.forecast(self.get_arg(query, 'country'), *self.forecast_args(query)))
+            elif url.path == '/compare':
+                countries = self.get_arg(query, 'countries').split(',')
+                self.send_json(200, {country : service.forecast(country, *self.forecast_args(query)) for country in countries})
+            else:
+                self.send_json(404, {'error' : "Unknown path " + url.path})
+        except KeyError as err:
+            self.send_json(404, {'error' : "Unknown country " + str(err)})
+        except ValueError as err:
+            self.send_json(400, {'error' : str(err)})
+        except Exception as err:
+            logger.error("Request " + self.path + " failed: " + repr(err))
+            self.send_json(500, {'error' : repr(err)})
+
+    def do_POST(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if url.path != '/refresh':
+            self.send_json(404, {'error' : "Unknown path " + url.path})
+            return
+        try:
+            generation = self.server.service.refresh(query.get('delta', ['0'])[0] in ['1', 'true'])
+            self.send_json(200, {'generation' : generation})
+        except dtmg.DownloadError as err:
+            self.send_json(502, {'error' : str(err)})
+        except Exception as err:
+            logger.error("Refresh failed: " + repr(err))
+            self.send_json(500, {'error' : repr(err)})
+
+    def get_arg(self, query, name):
+        if name not in query:
+            raise ValueError("Missing parameter '" + name + "'")
+        return query[name][0]
+
+    def forecast_args(self, query):
+        nDays = int(query.get('days', ['20'])[0])
+        quantiles = [float(quantile) for quantile in query['quantiles'][0].split(',')] if 'quantiles' in query else []
+        nDraws = int(query.get('draws', ['1000'])[0])
+        return nDays, quantiles, nDraws
+
+    def send_json(self, status, content):
+        body = json.dumps(content).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug("%s - %s", self.address_string(), format % args)
+
+def serve(service, host='127.0.0.1', port=8000):
+    server = ThreadingHTTPServer((host, port), ForecastRequestHandler)
+    server.service = service
+    logger.info("Forecast service listening on http://" + host + ":" + str(server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local HTTP service of SIR forecasts")
+    parser.add_argument('--data-dir', default=os.getcwd(), help="folder of the HDX and WPP files")
+    parser.add_argument('--store', default='sir_fits.json', help="json file of the fitted parameters")
+    parser.add_argument('--aggregate', action='store_true', help="sum the provinces of the countries")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8000)
+    args = parser.parse_args(argv)
+    instrumentation.setup_logging()
+    serve(ForecastService(args.data_dir, args.store, args.aggregate), args.host, args.port)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
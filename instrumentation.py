@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the data and SIR libraries
+- Messages go through the standard logging module, one logger per module: the level chooses what is shown
+- Stats objects count events (ODE solves, RHS evaluations, optimizer iterations, cache hits...) and time stages
+- Counters and timers are disabled by default: until enable() is called, they cost a single flag check
+
+Example:
+    import instrumentation
+    instrumentation.enable()
+    ... fitting of a SIRmodelFITset ...
+    print(setSIRmodels.fit_summary())
+"""
+
+import time
+import logging
+import contextlib
+
+enabled = False
+
+def enable(state=True):
+    global enabled
+    enabled = state
+
+def is_enabled():
+    return enabled
+
+class ConsoleFormatter(logging.Formatter):
+    # Warnings and errors are prefixed by their level, other messages are plain, as the libraries used to print them
+    def format(self, record):
+        message = super().format(record)
+        return record.levelname + ': ' + message if record.levelno >= logging.WARNING else message
+
+def setup_logging(level=logging.INFO):
+    handler = logging.StreamHandler()
+    handler.setFormatter(ConsoleFormatter('%(message)s'))
+    logging.basicConfig(level=level, handlers=[handler])
+
+class Stats(object):
+    def __init__(self):
+        self.counters = {}
+        self.timers = {}
+
+    def count(self, name, n=1):
+        if enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        if not enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timers[name] = self.timers.get(name, 0.0) + time.perf_counter() - start
+
+    def merge(self, other):
+        for name, n in other.counters.items():
+            self.counters[name] = self.counters.get(name, 0) + n
+        for name, seconds in other.timers.items():
+            self.timers[name] = self.timers.get(name, 0.0) + seconds
+
+    def reset(self):
+        self.counters = {}
+        self.timers = {}
+
+    def summary(self):
+        summary = dict(self.counters)
+        summary.update({name + '_seconds' : seconds for name, seconds in self.timers.items()})
+        return summary
\ No newline at end of file
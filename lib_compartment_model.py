@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -*-
+"""
+Library for compartmental models
+- CompartmentModel class describes a model by its compartments, parameters and transitions, e.g. SIRD or SEIR
+  Its right-hand side, jacobian and sensitivity equations are assembled once, as matrix operations over all the transitions
+- CompartmentModelFIT class fits a model jointly to several series of a country, e.g. confirmed, deaths and recovered of HDXdata
+- simulate_batch function integrates many parameter sets of a model at once on a shared time grid
+- SIR, SIRD and SEIR are predefined models
+
+Example:
+    parsedData = data.get_countryDataParsed('Italy')
+    model = CompartmentModelFIT(SIRD, parsedData.allValues, pops['Italy'], 'Italy')
+    model.opt_curvefit()
+    prediction = model.predict_days(30)
+"""
+
+import logging
+import numpy as np
+from instrumentation import Stats
+
+logger = logging.getLogger(__name__)
+
+# SciPy is imported by the methods integrating or fitting, as in lib_sir_model
+
+class Transition(object):
+    """
+    Flow from compartment source to compartment target, at rate parameter * source
+    With infectors, the flow is also multiplied by the sum of the infectors compartments divided by the population (mass action)
+    """
+    def __init__(self, source, target, parameter, infectors=()):
+        self.source = source
+        self.target = target
+        self.parameter = parameter
+        self.infectors = tuple(infectors)
+
+class CompartmentModel(object):
+    """
+    Compartmental model given by its compartments, parameters and transitions
+    - observables maps the names of the observed series to the compartments they sum, by default every compartment is observed
+    - seed is the compartment of the first infected person, by default the second compartment
+    The model is compiled once into matrices, so that the cost of an evaluation does not grow with one Python step per compartment:
+        flows = rates * source * pressure, with pressure = infectors @ y / N (or 1)
+        dy/dt = stoichiometry @ flows
+    """
+    def __init__(self, name, compartments, parameters, transitions, observables=None, seed=None):
+        self.name = name
+        self.compartments = list(compartments)
+        self.parameters = list(parameters)
+        self.transitions = list(transitions)
+        self.observables = observables if observables is not None else {compartment : [compartment] for compartment in self.compartments}
+        self.seed = seed if seed is not None else self.compartments[1]
+        self.compile()
+
+    def compile(self):
+        idxCompartment = {compartment : idx for idx, compartment in enumerate(self.compartments)}
+        idxParameter = {parameter : idx for idx, parameter in enumerate(self.parameters)}
+        nCompartments, nTransitions, nParameters = len(self.compartments), len(self.transitions), len(self.parameters)
+        self.source = np.array([idxCompartment[transition.source] for transition in self.transitions], dtype=np.intp)
+        self.target = np.array([idxCompartment[transition.target] for transition in self.transitions], dtype=np.intp)
+        self.rateIndex = np.array([idxParameter[transition.parameter] for transition in self.transitions], dtype=np.intp)
+        # Transitions x compartments: one-hot of the sources, indicators of the infectors
+        self.sourceMatrix = np.zeros((nTransitions, nCompartments))
+        self.sourceMatrix[np.arange(nTransitions), self.source] = 1
+        self.infectors = np.zeros((nTransitions, nCompartments))
+        for idxTransition, transition in enumerate(self.transitions):
+            for infector in transition.infectors:
+                self.infectors[idxTransition, idxCompartment[infector]] = 1
+        self.infective = self.infectors.any(axis=1)
+        # Compartments x transitions: what each flow removes and adds
+        self.stoichiometry = np.zeros((nCompartments, nTransitions))
+        self.stoichiometry[self.source, np.arange(nTransitions)] -= 1
+        self.stoichiometry[self.target, np.arange(nTransitions)] += 1
+        # Transitions x parameters: one-hot of the rate of each flow
+        self.rateMatrix = np.zeros((nTransitions, nParameters))
+        self.rateMatrix[np.arange(nTransitions), self.rateIndex] = 1
+        self.observationMatrix = np.zeros((len(self.observables), nCompartments))
+        for idxObservable, compartments in enumerate(self.observables.values()):
+            for compartment in compartments:
+                self.observationMatrix[idxObservable, idxCompartment[compartment]] = 1
+
+    def initial_state(self, N, seedCount=1):
+        y0 = np.zeros(len(self.compartments))
+        y0[0] = N - seedCount
+        y0[self.compartments.index(self.seed)] = seedCount
+        return y0
+
+    def pressure(self, y, N):
+        # Infection pressure of each transition, 1 for the transitions without infectors; y is shaped (n_compartments, ...)
+        infective = self.infective.reshape((-1,) + (1,)*(np.ndim(y) - 1))
+        return np.where(infective, self.infectors @ y / N, 1.0)
+
+    def base_flows(self, y, N):
+        # Flows of the transitions for unit rates
+        return y[self.source] * self.pressure(y, N)
+
+    def ODEs(self, t, y, params, N):
+        # params is shaped (n_parameters,) or (n_parameters, n_models) for y shaped (n_compartments, n_models)
+        return self.stoichiometry @ (params[self.rateIndex] * self.base_flows(y, N))
+
+    def base_jacobian(self, y, N):
+        # Derivatives of the unit-rate flows with respect to the compartments, shaped (n_transitions, n_compartments)
+        return (y[self.source] / N)[:, None] * self.infectors + self.sourceMatrix * self.pressure(y, N)[:, None]
+
+    def jacobian(self, t, y, params, N):
+        return self.stoichiometry @ (params[self.rateIndex][:, None] * self.base_jacobian(y, N))
+
+    def sensitivity_ODEs(self, t, z, params, N):
+        """
+        States followed by their derivatives with respect to the parameters, flattened as (n_compartments, n_parameters)
+        dSy/dt = J Sy + stoichiometry @ (rateMatrix * unit-rate flows)
+        """
+        nCompartments = len(self.compartments)
+        y = z[0:nCompartments]
+        Sy = z[nCompartments:].reshape(nCompartments, len(self.parameters))
+        baseFlows = self.base_flows(y, N)
+        J = self.stoichiometry @ (params[self.rateIndex][:, None] * self.base_jacobian(y, N))
+        dSy = J @ Sy + self.stoichiometry @ (self.rateMatrix * baseFlows[:, None])
+        return np.concatenate((self.stoichiometry @ (params[self.rateIndex] * baseFlows), dSy.ravel()))
+
+    def sensitivity_jacobian(self, t, z, params, N):
+        nCompartments, nParameters = len(self.compartments), len(self.parameters)
+        y = z[0:nCompartments]
+        Sy = z[nCompartments:].reshape(nCompartments, nParameters)
+        rates = params[self.rateIndex]
+        baseJacobian = self.base_jacobian(y, N)
+        J = self.stoichiometry @ (rates[:, None] * baseJacobian)
+        # Derivatives of J @ Sy and of the parameter terms with respect to the compartments, shaped (n_transitions, n_parameters, n_compartments)
+        dFlows = (rates / N)[:, None, None] * (self.sourceMatrix[:, None, :] * (self.infectors @ Sy)[:, :, None]
+                                               + self.infectors[:, None, :] * Sy[self.source][:, :, None])
+        dFlows += self.rateMatrix[:, :, None] * baseJacobian[:, None, :]
+        jac = np.zeros((nCompartments*(1 + nParameters), nCompartments*(1 + nParameters)))
+        jac[0:nCompartments, 0:nCompartments] = J
+        jac[nCompartments:, 0:nCompartments] = np.einsum('ik,kml->iml', self.stoichiometry, dFlows).reshape(nCompartments*nParameters, nCompartments)
+        jac[nCompartments:, nCompartments:] = np.kron(J, np.eye(nParameters))
+        return jac
+
+    def observe(self, y):
+        # Observed series of the states y shaped (n_compartments, ...)
+        return self.observationMatrix @ y[0:len(self.compartments)]
+
+    def simulate(self, time_data, params, N, y0=None, stats=None):
+        import scipy.integrate as integrate
+        t = np.asarray(time_data, dtype=float)
+        y0 = self.initial_state(N) if y0 is None else y0
+        params = np.asarray(params, dtype=float)
+        res = integrate.solve_ivp(self.ODEs, (t[0], t[-1]), y0, t_eval=t, method='LSODA', jac=self.jacobian, args=(params, N))
+        self.count_solve(res, stats)
+        return res
+
+    def simulate_sensitivity(self, time_data, params, N, y0=None, stats=None, rtol=1e-6, atol=1e-6):
+        """
+        Integration of the model together with its forward sensitivity equations
+        Returns the solve_ivp result: y[0:n_compartments] are the compartments,
+        y[n_compartments:] their derivatives with respect to the parameters, ordered compartment by compartment
+        """
+        import scipy.integrate as integrate
+        t = np.asarray(time_data, dtype=float)
+        y0 = self.initial_state(N) if y0 is None else y0
+        z0 = np.concatenate((y0, np.zeros(len(self.compartments)*len(self.parameters))))
+        params = np.asarray(params, dtype=float)
+        res = integrate.solve_ivp(self.sensitivity_ODEs, (t[0], t[-1]), z0, t_eval=t, method='LSODA',
+                                  jac=self.sensitivity_jacobian, args=(params, N), rtol=rtol, atol=atol)
+        self.count_solve(res, stats)
+        return res
+
+    def count_solve(self, res, stats):
+        if stats is not None:
+            stats.count('ode_solves')
+            stats.count('rhs_evals', int(res.nfev))
+            stats.count('jac_evals', int(res.njev))
+
+def simulate_batch(model, time_data, N, params, y0=None, substeps=10):
+    """
+    Integration of n_models parameter sets of model with a fixed-step Runge-Kutta 4 scheme, all sets advance together
+    - params is shaped (n_models, n_parameters), N is a scalar or an array of length n_models
+    - y0 is either a single initial state or an array shaped (n_models, n_compartments), by default model.initial_state(N)
+    Returns an array shaped (n_models, n_compartments, n_times)
+    """
+    t = np.asarray(time_data, dtype=float)
+    params = np.atleast_2d(np.asarray(params, dtype=float)).T
+    nModels = params.shape[1]
+    N = np.broadcast_to(np.asarray(N, dtype=float), (nModels,))
+    if y0 is None:
+        y0 = np.array([model.initial_state(pop) for pop in N])
+    y = np.broadcast_to(np.atleast_2d(np.asarray(y0, dtype=float)), (nModels, len(model.compartments))).T.copy()
+    res = np.empty((nModels, len(model.compartments), len(t)))
+    res[:, :, 0] = y.T
+    for idxT in range(1, len(t)):
+        h = (t[idxT] - t[idxT-1]) / substeps
+        for step in range(substeps):
+            k1 = model.ODEs(t, y, params, N)
+            k2 = model.ODEs(t, y + 0.5*h*k1, params, N)
+            k3 = model.ODEs(t, y + 0.5*h*k2, params, N)
+            k4 = model.ODEs(t, y + h*k3, params, N)
+            y = y + h/6 * (k1 + 2*k2 + 2*k3 + k4)
+        res[:, :, idxT] = y.T
+    return res
+
+SIR = CompartmentModel('SIR', ['S', 'I', 'R'], ['beta', 'gamma'],
+                       [Transition('S', 'I', 'beta', infectors=['I']),
+                        Transition('I', 'R', 'gamma')],
+                       observables={'confirmed' : ['I', 'R'], 'recovered' : ['R']})
+
+SIRD = CompartmentModel('SIRD', ['S', 'I', 'R', 'D'], ['beta', 'gamma', 'mu'],
+                        [Transition('S', 'I', 'beta', infectors=['I']),
+                         Transition('I', 'R', 'gamma'),
+                         Transition('I', 'D', 'mu')],
+                        observables={'confirmed' : ['I', 'R', 'D'], 'deaths' : ['D'], 'recovered' : ['R']})
+
+SEIR = CompartmentModel('SEIR', ['S', 'E', 'I', 'R'], ['beta', 'sigma', 'gamma'],
+                        [Transition('S', 'E', 'beta', infectors=['I']),
+                         Transition('E', 'I', 'sigma'),
+                         Transition('I', 'R', 'gamma')],
+                        observables={'confirmed' : ['I', 'R'], 'recovered' : ['R']},
+                        seed='E')
+
+class CompartmentModelFIT(object):
+    """
+    Joint fit of a CompartmentModel to the series of a country
+    countryData maps names of series to their values, e.g. ParsedDataCountry.allValues: the series named as observables of the model are fitted
+    Every series is scaled by its maximum, so that deaths weigh as much as confirmed cases
+    """
+    def __init__(self, model, countryData, pop, country=''):
+        self.model = model
+        self.country = country
+        self.pop = pop
+        self.observed = [name for name in model.observables.keys() if name in countryData.keys()]
+        if len(self.observed) == 0:
+            logger.error("No series of country '" + country + "' is an observable of model " + model.name + "!")
+        idxObservables = list(model.observables.keys())
+        self.observedIndex = np.array([idxObservables.index(name) for name in self.observed], dtype=np.intp)
+        self.data = np.vstack([np.asarray(countryData[name], dtype=float) for name in self.observed])
+        self.tDays = np.linspace(1, self.data.shape[1], self.data.shape[1])
+        self.scales = np.maximum(np.max(np.abs(self.data), axis=1), 1)
+        self.params = None
+        self.paramsCov = None
+        self.lastSensitivity = None
+        self.stats = Stats()
+
+    def simulate_sensitivity(self, t, params):
+        # The last solution is kept, since curve_fit asks for function and jacobian at the same parameters
+        key = (tuple(params), len(t), t[0], t[-1])
+        if self.lastSensitivity is None or self.lastSensitivity[0] != key:
+            res = self.model.simulate_sensitivity(t, params, self.pop, stats=self.stats)
+            if not res.success:
+                # Reported as a convergence failure, like those of curve_fit, instead of returning a truncated trajectory
+                raise RuntimeError("Integration failed at parameters " + ', '.join('%g' % p for p in params) + ": " + res.message)
+            self.lastSensitivity = (key, res.y)
+        return self.lastSensitivity[1]
+
+    def fun_curvefit(self, t, *params):
+        self.stats.count('fit_evals')
+        y = self.simulate_sensitivity(t, params)
+        observations = self.model.observe(y)[self.observedIndex]
+        return (observations / self.scales[:, None]).ravel()
+
+    def jac_curvefit(self, t, *params):
+        self.stats.count('optimizer_iterations')
+        nCompartments, nParameters = len(self.model.compartments), len(self.model.parameters)
+        y = self.simulate_sensitivity(t, params)
+        Sy = y[nCompartments:].reshape(nCompartments, nParameters, len(t))
+        dObservations = np.einsum('oc,cpt->opt', self.model.observationMatrix[self.observedIndex], Sy) / self.scales[:, None, None]
+        return dObservations.transpose(0, 2, 1).reshape(-1, nParameters)
+
+    def opt_curvefit(self, IC=None):
+        # Parameters are kept positive; without IC, every rate starts from 0.1
+        logger.info('\n' + "Starting joint fitting of " + ', '.join(self.observed) + " with model " + self.model.name + " for country " + self.country)
+        from scipy.optimize import curve_fit
+        IC = np.full(len(self.model.parameters), 0.1) if IC is None else IC
+        with self.stats.timer('fit'):
+            params, paramsCov = curve_fit(self.fun_curvefit, self.tDays, (self.data / self.scales[:, None]).ravel(), IC,
+                                          jac=self.jac_curvefit, bounds=(0, np.inf))
+        self.params = params
+        self.paramsCov = paramsCov
+        return params
+
+    def get_params(self):
+        if self.params is None:
+            return {}
+        return dict(zip(self.model.parameters, self.params))
+
+    def predict_days(self, nDays):
+        # Every observable of the model over the data days extended by nDays, as a dictionary name -> values
+        t = np.linspace(1, len(self.tDays) + nDays, len(self.tDays) + nDays)
+        res = self.model.simulate(t, self.params, self.pop, stats=self.stats)
+        return dict(zip(self.model.observables.keys(), self.model.observe(res.y)))
\ No newline at end of file
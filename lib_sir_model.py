@@ -4,15 +4,70 @@ Library for SIR Model
 - SIRmodel class is a generic SIR model, able to be simulated
 - SIRmodelFIT class uses data of confirmed cases of a country and fits it
 - SIRmodelFITset class is a set of fitting models of different countries
+- SIRfitStore class keeps the fitted parameters of the countries, persistently if a path is given
+- simulate_batch function integrates many SIR models at once on a shared time grid
+- SIRmodelFIT.predict_days and plot_prediction give quantile bands from an ensemble of parameters drawn around the fit
+- SIRmodelFITset.opt_fast estimates all the countries at once from their early exponential growth, without solving ODEs
+- SIRmodelFITset.export_results writes parameters, diagnostics and forecasts of all the countries to Parquet (CSV without pyarrow),
+  to be read back by data_manager.read_sir_export
+- SIRmodelFITset.backtest scores the forecasts of the fits at every past cutoff day (rolling origin)
 """
 
 import numpy as np
-import scipy.integrate as integrate
-import matplotlib.pyplot as plt
 import datetime
-from scipy.optimize import minimize
-from scipy.optimize import curve_fit
-import matplotlib.ticker as ticker
+import hashlib
+import json
+import os
+import re
+import copy
+import logging
+import warnings
+import importlib.util
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import instrumentation
+from instrumentation import Stats
+
+logger = logging.getLogger(__name__)
+
+# SciPy, matplotlib and pandas are imported by the functions using them: simulating with simulate_batch,
+# reading fitted parameters and forecasting from them do not pay for their import
+
+def SIR_ODEs_batch(S, I, N, beta, gamma):
+    infections = beta*S*I / N
+    recoveries = gamma*I
+    return -infections, infections - recoveries, recoveries
+
+def simulate_batch(time_data, N, beta, gamma, y0, substeps=10):
+    """
+    Integration of n_models SIR models with a fixed-step Runge-Kutta 4 scheme, all models advance together
+    - N, beta, gamma are scalars or arrays of length n_models
+    - y0 is either a single initial condition [S0, I0, R0] or an array shaped (n_models, 3)
+    - Every interval of time_data is divided into substeps integration steps
+    Returns an array shaped (n_models, 3, n_times)
+    """
+    t = np.asarray(time_data, dtype=float)
+    N, beta, gamma = np.broadcast_arrays(*[np.atleast_1d(np.asarray(x, dtype=float)) for x in (N, beta, gamma)])
+    y0 = np.atleast_2d(np.asarray(y0, dtype=float))
+    nModels = max(len(N), len(y0))
+    N, beta, gamma = [np.broadcast_to(x, (nModels,)) for x in (N, beta, gamma)]
+    y0 = np.broadcast_to(y0, (nModels, 3))
+    res = np.empty((nModels, 3, len(t)))
+    S, I, R = y0[:, 0].copy(), y0[:, 1].copy(), y0[:, 2].copy()
+    res[:, 0, 0], res[:, 1, 0], res[:, 2, 0] = S, I, R
+    for idxT in range(1, len(t)):
+        h = (t[idxT] - t[idxT-1]) / substeps
+        for step in range(substeps):
+            k1 = SIR_ODEs_batch(S, I, N, beta, gamma)
+            k2 = SIR_ODEs_batch(S + 0.5*h*k1[0], I + 0.5*h*k1[1], N, beta, gamma)
+            k3 = SIR_ODEs_batch(S + 0.5*h*k2[0], I + 0.5*h*k2[1], N, beta, gamma)
+            k4 = SIR_ODEs_batch(S + h*k3[0], I + h*k3[1], N, beta, gamma)
+            S = S + h/6 * (k1[0] + 2*k2[0] + 2*k3[0] + k4[0])
+            I = I + h/6 * (k1[1] + 2*k2[1] + 2*k3[1] + k4[1])
+            R = R + h/6 * (k1[2] + 2*k2[2] + 2*k3[2] + k4[2])
+        res[:, 0, idxT], res[:, 1, idxT], res[:, 2, idxT] = S, I, R
+    return res
 
 class SIRmodel(object):
     def __init__(self, N, beta, gamma):
@@ -23,51 +78,178 @@ class SIRmodel(object):
         self.res = []
         self.name = 'None'
         self.y0 = []
+        self.method = 'RK45'
+        self.cacheSize = 32
+        self.cache = OrderedDict()
+        self.cacheHits = 0
+        self.cacheMisses = 0
+        self.stats = Stats()
         
     def set_name(self, name):
         self.name = name
         
     def set_pop(self, pop):
         if pop==0:
-            print("ERROR: Population of model called '" + self.name + "' cannot be corresponding to zero!")
+            logger.error("Population of model called '" + self.name + "' cannot be corresponding to zero!")
             pass
+        if pop != self.N:
+            self.clear_cache()
         self.N = pop
         
     def set_beta(self, beta):
+        if beta != self.beta:
+            self.clear_cache()
         self.beta = beta
         
     def set_gamma(self, gamma):
+        if gamma != self.gamma:
+            self.clear_cache()
         self.gamma = gamma
         
+    def set_method(self, method):
+        if method != self.method:
+            self.clear_cache()
+        self.method = method
+        
+    def clear_cache(self):
+        self.cache.clear()
+        
+    def cache_info(self):
+        return {'hits' : self.cacheHits, 'misses' : self.cacheMisses, 'size' : len(self.cache), 'maxsize' : self.cacheSize}
+        
+    def ODEs(self, t, y):
+        S = y[0]
+        I = y[1]
+        return [-self.beta*S*I / self.N, self.beta*S*I / self.N - self.gamma*I, self.gamma*I]
+    
+    def jacobian(self, t, y):
+        S = y[0]
+        I = y[1]
+        return np.array([[-self.beta*I / self.N, -self.beta*S / self.N, 0],
+                         [self.beta*I / self.N, self.beta*S / self.N - self.gamma, 0],
+                         [0, self.gamma, 0]])
+    
+    def sensitivity_ODEs(self, t, y):
+        # States S, I, R followed by their derivatives with respect to beta and to gamma
+        S, I = y[0], y[1]
+        Sb, Ib = y[3], y[4]
+        Sg, Ig = y[6], y[7]
+        infections = self.beta*S*I / self.N
+        dInfections_b = (S*I + self.beta*(Sb*I + S*Ib)) / self.N
+        dInfections_g = self.beta*(Sg*I + S*Ig) / self.N
+        return [-infections, infections - self.gamma*I, self.gamma*I,
+                -dInfections_b, dInfections_b - self.gamma*Ib, self.gamma*Ib,
+                -dInfections_g, dInfections_g - I - self.gamma*Ig, I + self.gamma*Ig]
+    
+    def sensitivity_jacobian(self, t, y):
+        S, I = y[0], y[1]
+        Sb, Ib = y[3], y[4]
+        Sg, Ig = y[6], y[7]
+        J = np.zeros((9, 9))
+        Jsir = self.jacobian(t, y)
+        for idx in range(3):
+            J[3*idx:3*idx+3, 3*idx:3*idx+3] = Jsir
+        # Derivatives of the beta sensitivities with respect to S and I
+        dS = (self.beta*Ib + I) / self.N
+        dI = (self.beta*Sb + S) / self.N
+        J[3, 0:2] = [-dS, -dI]
+        J[4, 0:2] = [dS, dI]
+        # Derivatives of the gamma sensitivities with respect to S and I
+        dS = self.beta*Ig / self.N
+        dI = self.beta*Sg / self.N
+        J[6, 0:2] = [-dS, -dI]
+        J[7, 0:2] = [dS, dI - 1]
+        J[8, 1] = 1
+        return J
+        
+    def integrate(self, t, y0):
+        import scipy.integrate as integrate
+        if self.method in ['Radau', 'BDF', 'LSODA']:
+            res = integrate.solve_ivp(self.ODEs, (t[0], t[-1]), y0, t_eval=t, method=self.method, jac=self.jacobian)
+        else:
+            res = integrate.solve_ivp(self.ODEs, (t[0], t[-1]), y0, t_eval=t, method=self.method)
+        self.count_solve(res)
+        return res
+    
+    def count_solve(self, res):
+        self.stats.count('ode_solves')
+        self.stats.count('rhs_evals', int(res.nfev))
+        self.stats.count('jac_evals', int(res.njev))
+        
     def simulate(self, time_data, y0):
-        def SIR_ODEs(t, y):
-            S = y[0]
-            I = y[1]
-            R = y[2]
-            return [-self.beta*S*I / self.N, self.beta*S*I / self.N - self.gamma*I, self.gamma*I]
+        """
+        Simulation on npoints equally spaced days between the first and the last of time_data
+        Trajectories are kept in an LRU cache keyed by the model, y0, the first day and the spacing:
+        a longer horizon extends a cached trajectory instead of integrating again from the first day
+        """
         t0 = time_data[0]
         tf = time_data[-1]
         self.y0 = y0
         npoints = len(time_data)
         self.t = np.linspace(t0, tf, npoints)
-        self.res = integrate.solve_ivp(SIR_ODEs, (t0, tf), y0, t_eval=self.t)
+        if npoints < 2:
+            self.res = self.integrate(self.t, y0)
+            return self.res
+        step = round((tf - t0) / (npoints - 1), 12)
+        key = (self.N, self.beta, self.gamma, tuple(y0), self.method, t0, step)
+        cached = self.cache.get(key)
+        if cached is None:
+            self.cacheMisses += 1
+            self.stats.count('cache_misses')
+            res = self.integrate(self.t, y0)
+            y = res.y
+            if not res.success:
+                self.res = res
+                return self.res
+        else:
+            self.cacheHits += 1
+            self.stats.count('cache_hits')
+            self.cache.move_to_end(key)
+            y = cached
+            if y.shape[1] < npoints:
+                res = self.integrate(self.t[y.shape[1]-1:], y[:, -1])
+                if not res.success:
+                    self.res = res
+                    return self.res
+                y = np.hstack((y, res.y[:, 1:]))
+        if cached is None or y.shape[1] > cached.shape[1]:
+            self.cache.update({key : y})
+            self.cache.move_to_end(key)
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        from scipy.optimize import OptimizeResult
+        self.res = OptimizeResult(t=self.t, y=y[:, 0:npoints], success=True, message='Trajectory of cache key ' + repr(key))
         return self.res
     
+    def simulate_sensitivity(self, time_data, y0, rtol=1e-6, atol=1e-6):
+        """
+        Integration of the SIR model together with its forward sensitivity equations
+        Returns the solve_ivp result: y[0:3] are S, I, R, y[3:6] their derivatives with respect to beta, y[6:9] with respect to gamma
+        """
+        import scipy.integrate as integrate
+        t = np.linspace(time_data[0], time_data[-1], len(time_data))
+        y0 = list(y0) + [0]*6
+        res = integrate.solve_ivp(self.sensitivity_ODEs, (t[0], t[-1]), y0, t_eval=t, method='LSODA',
+                                  jac=self.sensitivity_jacobian, rtol=rtol, atol=atol)
+        self.count_solve(res)
+        return res
+    
     def plotres(self, dpi=300, t=[]):
-        if t==[] or self.y0==[]:
-            if self.res==[]:
-                print("ERROR: Result is empty! Impossible to plot data.")
+        if len(t)==0 or len(self.y0)==0:
+            if len(self.res)==0:
+                logger.error("Result is empty! Impossible to plot data.")
                 pass
             t = self.res.t
             S = self.res.y[0]
             I = self.res.y[1]
             R = self.res.y[2]
         else:
-            if self.y0 == []:
-                print("ERROR: Initial conditions are empty! No simulations will be performed.")
+            if len(self.y0) == 0:
+                logger.error("Initial conditions are empty! No simulations will be performed.")
                 pass
             res = self.simulate(t, self.y0)
             S, I, R = res.y[0], res.y[1], res.y[2]
+        import matplotlib.pyplot as plt
         fig = plt.figure()
         ax = plt.subplot(111)
         ax.plot(t, S, label='S')
@@ -86,19 +268,24 @@ class SIRmodel(object):
 class SIRmodelFIT(object):
     def __init__(self, countriesDataConfirmed, countryPops=[], country=''):
         if country=='' or not country in countriesDataConfirmed.keys():
-            print("ERROR: Country '" + country + "' is either invalid or could not be found in the provided data!")
+            logger.error("Country '" + country + "' is either invalid or could not be found in the provided data!")
             pass
         if countryPops==[] or not country in countryPops.keys():
-            print("ERROR: Country population cannot be corresponding to zero!")
+            logger.error("Country population cannot be corresponding to zero!")
             pass
         self.country = country
         self.pop = countryPops[country]
         self.SIRmodel = SIRmodel(self.pop, 0, 0)
         self.SIRmodel.set_name(country)
         countryDataConfirmed = countriesDataConfirmed[country]
-        self.data = np.array(countryDataConfirmed.to_list())
+        # View of the values of the series, not a copy: the data are only read
+        self.data = np.asarray(countryDataConfirmed)
         self.tDate = self.reformat_date(countryDataConfirmed.index)
         self.tDays = self.dates_to_days(self.tDate)
+        self.params = None
+        self.paramsCov = None
+        self.lastSensitivity = None
+        self.stats = self.SIRmodel.stats
         
     def reformat_date(self, dateStr):
         dates_formatted = [datetime.datetime.strptime(date, '%m/%d/%y').date() for date in dateStr]
@@ -107,29 +294,185 @@ class SIRmodelFIT(object):
     def dates_to_days(self, dates):
         return np.linspace(1, len(dates), len(dates))
         
+    def simulate_sensitivity(self, t, beta, gamma):
+        # The last solution is kept, since curve_fit asks for function and jacobian at the same parameters
+        key = (beta, gamma, len(t), t[0], t[-1])
+        if self.lastSensitivity is None or self.lastSensitivity[0] != key:
+            self.SIRmodel.set_beta(beta)
+            self.SIRmodel.set_gamma(gamma)
+            res = self.SIRmodel.simulate_sensitivity(t, [self.SIRmodel.N, 1, 0])
+            if not res.success:
+                # Reported as a convergence failure, like those of curve_fit, instead of returning a truncated trajectory
+                raise RuntimeError("Integration failed at beta=%g gamma=%g: %s" % (beta, gamma, res.message))
+            self.lastSensitivity = (key, res.y)
+        return self.lastSensitivity[1]
+        
     def loss_fun_rmse(self, params):
-        print("Evaluation of RMSE loss function with parameters: " + ' '.join('{}'.format(k) for k in params))
-        self.SIRmodel.set_beta(params[0])
-        self.SIRmodel.set_gamma(params[1])
-        res = self.SIRmodel.simulate(self.tDays, [self.SIRmodel.N, 1, 0])
-        return np.sqrt(np.mean(res.y[1] - self.data)**2)
+        return self.loss_grad_rmse(params)[0]
+    
+    def loss_grad_rmse(self, params):
+        logger.debug("Evaluation of RMSE loss function with parameters: %f %f", params[0], params[1])
+        self.stats.count('fit_evals')
+        y = self.simulate_sensitivity(self.tDays, params[0], params[1])
+        residuals = y[1] - self.data
+        rmse = np.sqrt(np.mean(residuals**2))
+        if rmse == 0:
+            return rmse, np.zeros(2)
+        return rmse, np.array([np.mean(residuals*y[4]), np.mean(residuals*y[7])]) / rmse
     
     def opt_minrmse(self, IC, bnds=None, tolerance=None):
-        print('\n' + "Starting fitting with minimization of RMSE for country " + self.country)
-        return minimize(self.loss_fun_rmse, IC, bounds=bnds, tol=tolerance)
+        logger.info('\n' + "Starting fitting with minimization of RMSE for country " + self.country)
+        from scipy.optimize import minimize
+        opt = minimize(self.loss_grad_rmse, IC, jac=True, bounds=bnds, tol=tolerance)
+        self.stats.count('optimizer_iterations', int(opt.get('nit', 0)))
+        self.set_params(opt.x)
+        return opt
     
     def fun_curvefit(self, t, beta, gamma):
-        print("Evaluation of fitting function with parameters: %f %f" % (beta, gamma)) #+ ' '.join('{}'.format(k) for k in params))
-        self.SIRmodel.set_beta(beta)
-        self.SIRmodel.set_gamma(gamma)
-        res = self.SIRmodel.simulate(t, [self.SIRmodel.N, 1, 0])
-        return res.y[1]
+        logger.debug("Evaluation of fitting function with parameters: %f %f", beta, gamma)
+        self.stats.count('fit_evals')
+        return self.simulate_sensitivity(t, beta, gamma)[1]
+    
+    def jac_curvefit(self, t, beta, gamma):
+        # The Levenberg-Marquardt method evaluates the jacobian once per iteration
+        self.stats.count('optimizer_iterations')
+        y = self.simulate_sensitivity(t, beta, gamma)
+        return np.column_stack((y[4], y[7]))
     
     def opt_curvefit(self, IC):
-        print('\n' + "Starting fitting with non-linear LSQR method for country " + self.country)
-        return curve_fit(self.fun_curvefit, self.tDays, self.data, IC)[0]
+        logger.info('\n' + "Starting fitting with non-linear LSQR method for country " + self.country)
+        from scipy.optimize import curve_fit
+        params, paramsCov = curve_fit(self.fun_curvefit, self.tDays, self.data, IC, jac=self.jac_curvefit)
+        self.set_params(params, paramsCov)
+        return params
+    
+    def opt_global(self, betaRange=(1e-2, 2), gammaRange=(1e-3, 1), nGrid=32, nBest=3):
+        """
+        Coarse-to-fine fitting: a log-spaced grid of beta x gamma is simulated in one batch,
+        then opt_curvefit is started only from the nBest candidates of the grid
+        """
+        logger.info('\n' + "Starting global search on a " + str(nGrid) + "x" + str(nGrid) + " grid for country " + self.country)
+        betas, gammas = np.meshgrid(np.logspace(np.log10(betaRange[0]), np.log10(betaRange[1]), nGrid),
+                                    np.logspace(np.log10(gammaRange[0]), np.log10(gammaRange[1]), nGrid))
+        betas, gammas = betas.ravel(), gammas.ravel()
+        N = self.SIRmodel.N
+        with np.errstate(over='ignore', invalid='ignore'), self.stats.timer('global_search'):
+            res = simulate_batch(self.tDays, N, betas, gammas, [N, 1, 0], substeps=4)
+            sse = np.sum((res[:, 1, :] - self.data)**2, axis=1)
+        self.stats.count('batch_simulations', len(betas))
+        sse[~np.isfinite(sse)] = np.inf
+        bestParams, bestCov, bestSse = None, None, np.inf
+        for idx in np.argsort(sse)[0:nBest]:
+            try:
+                params = self.opt_curvefit((betas[idx], gammas[idx]))
+            except RuntimeError as err:
+                logger.warning("Refinement from beta=%f gamma=%f did not converge: %s" % (betas[idx], gammas[idx], err))
+                continue
+            paramsSse = np.sum((self.simulate_sensitivity(self.tDays, params[0], params[1])[1] - self.data)**2)
+            if paramsSse < bestSse:
+                bestParams, bestCov, bestSse = params, self.paramsCov, paramsSse
+        if bestParams is None:
+            idx = np.argmin(sse)
+            logger.warning("No refinement converged for country " + self.country + ", the best grid point is kept")
+            bestParams = np.array([betas[idx], gammas[idx]])
+        self.set_params(bestParams, bestCov)
+        return self.params
+    
+    def has_population(self):
+        # POPdata.get_pop_country returns [] for the countries missing from the WPP file
+        return np.ndim(self.pop) == 0 and self.pop > 0
+    
+    def fingerprint(self):
+        if not self.has_population():
+            raise ValueError("No population known for country '" + self.country + "'")
+        sha = hashlib.sha1(np.ascontiguousarray(self.data, dtype=float).tobytes())
+        sha.update(repr((float(self.pop), self.tDate[0], self.tDate[-1])).encode())
+        return sha.hexdigest()
+    
+    def set_stats(self, stats):
+        self.stats = stats
+        self.SIRmodel.stats = stats
+    
+    def set_params(self, params, paramsCov=None):
+        # paramsCov is the covariance of the parameters estimated by the fit, None if unknown
+        self.params = np.asarray(params)
+        self.paramsCov = None if paramsCov is None else np.asarray(paramsCov, dtype=float)
+        self.SIRmodel.set_beta(self.params[0])
+        self.SIRmodel.set_gamma(self.params[1])
+    
+    def until(self, nDays):
+        # Model of the same country knowing only the first nDays of data, used to backtest the forecasts
+        model = copy.copy(self)
+        model.SIRmodel = SIRmodel(self.pop, 0, 0)
+        model.SIRmodel.set_name(self.country)
+        model.set_stats(self.stats)
+        model.data = self.data[0:nDays]
+        model.tDate = self.tDate[0:nDays]
+        model.tDays = self.tDays[0:nDays]
+        model.params = None
+        model.paramsCov = None
+        model.lastSensitivity = None
+        return model
+    
+    def sample_params(self, nDraws=1000, method='covariance', seed=0):
+        """
+        Draws of (beta, gamma) around the fitted parameters, shaped (nDraws, 2)
+        - 'covariance' samples the normal distribution given by the covariance of the fit
+        - 'bootstrap' resamples the residuals of the fit and maps each resample to parameters with one Gauss-Newton step,
+          with the sensitivities of the fit: no refitting is needed
+        Draws are reflected to positive values; None if the fit gives no usable spread
+        """
+        if self.params is None:
+            logger.error("Country '" + self.country + "' has not been fitted yet!")
+            return None
+        rng = np.random.default_rng(seed)
+        if method == 'covariance':
+            if self.paramsCov is None or not np.all(np.isfinite(self.paramsCov)):
+                logger.warning("No covariance of the fit of country '" + self.country + "', no ensemble can be drawn")
+                return None
+            draws = rng.multivariate_normal(self.params, self.paramsCov, nDraws, check_valid='ignore')
+        elif method == 'bootstrap':
+            y = self.simulate_sensitivity(self.tDays, self.params[0], self.params[1])
+            jac = np.column_stack((y[4], y[7]))
+            residuals = self.data - y[1]
+            resampled = residuals[rng.integers(0, len(residuals), (nDraws, len(residuals)))]
+            steps = np.linalg.lstsq(jac, resampled.T, rcond=None)[0]
+            draws = self.params + steps.T
+        else:
+            logger.error("Unknown sampling method '" + method + "'!")
+            return None
+        return np.abs(draws)
+    
+    def ensemble(self, dates, nDraws=1000, quantiles=(0.05, 0.5, 0.95), method='covariance', seed=0):
+        """
+        Quantiles of the infected people over the ensemble of sample_params, all the draws being simulated in one batch
+        Returns an array shaped (len(quantiles), len(dates)), None if no ensemble can be drawn
+        """
+        draws = self.sample_params(nDraws, method, seed)
+        if draws is None:
+            return None
+        N = self.SIRmodel.N
+        with np.errstate(over='ignore', invalid='ignore'), self.stats.timer('ensemble'):
+            res = simulate_batch(self.dates_to_days(dates), N, draws[:, 0], draws[:, 1], [N, 1, 0], substeps=4)
+        self.stats.count('batch_simulations', len(draws))
+        infected = res[:, 1, :]
+        infected = infected[np.all(np.isfinite(infected), axis=1)]
+        return np.quantile(infected, quantiles, axis=0)
+    
+    def forecast(self, nDays, quantiles=(), nDraws=1000):
+        """
+        Forecast of the infected people for the nDays following the data, simulated as predict_days does (see simulate_model)
+        Returns the dates, the forecast and, with quantiles, the bands of the ensemble shaped (len(quantiles), nDays) - otherwise None
+        """
+        dates = self.extend_date(self.tDate, nDays + 1)
+        prediction = self.simulate_model(dates)
+        bands = self.ensemble(dates, nDraws, quantiles) if len(quantiles) > 0 else None
+        nData = len(self.tDate)
+        return dates[nData:], prediction[nData:], None if bands is None else bands[:, nData:]
     
     def plot_compare_reference(self, dpi=300, dates=None):
+        import matplotlib.pyplot as plt
+        import matplotlib.ticker as ticker
         if dates == None:
             dates = self.tDate
         fig = plt.figure()
@@ -156,43 +499,460 @@ class SIRmodelFIT(object):
         return [day.strftime('%d/%m/%y') for day in dates_formatted + dates_toadd]
     
     def simulate_model(self, dates=None):
+        # Infected people simulated with simulate_batch: forecast, predict_days and the plots share one integrator, without SciPy
         if dates == None:
             dates = self.tDate
         actModel = self.SIRmodel
-        return actModel.simulate(self.dates_to_days(dates), [actModel.N, 1, 0]).y[1]
+        return simulate_batch(self.dates_to_days(dates), actModel.N, actModel.beta, actModel.gamma, [actModel.N, 1, 0])[0, 1]
     
-    def predict_days(self, nDays):
-        return self.simulate_model(self.extend_date(self.tDate, nDays))
+    def predict_days(self, nDays, quantiles=None, nDraws=1000, method='covariance', seed=0):
+        """
+        Infected people over the data dates extended by nDays
+        With quantiles, returns also the bands of the ensemble (see ensemble), None if they cannot be computed
+        """
+        dates = self.extend_date(self.tDate, nDays)
+        prediction = self.simulate_model(dates)
+        if quantiles is None:
+            return prediction
+        return prediction, self.ensemble(dates, nDraws, quantiles, method, seed)
     
-    def plot_prediction(self, nDays=0, dpi=300):
-        fig, ax = self.plot_compare_reference(dpi, self.extend_date(self.tDate, nDays))
+    def plot_prediction(self, nDays=0, dpi=300, quantiles=(0.05, 0.95), nDraws=1000, method='covariance'):
+        # The band between the quantiles of the ensemble is shaded, quantiles=None draws the fit only
+        dates = self.extend_date(self.tDate, nDays)
+        fig, ax = self.plot_compare_reference(dpi, dates)
+        if quantiles is not None and self.params is not None:
+            bands = self.ensemble(dates, nDraws, quantiles, method)
+            if bands is not None:
+                ax.fill_between(dates, bands[0], bands[-1], alpha=0.3, label='Fit ' + '-'.join('%g%%' % (100*q) for q in (quantiles[0], quantiles[-1])))
+                ax.legend()
         return fig, ax
         
     def plotres(self, dpi=300, dates=[]):
-        if dates==[]:
+        if len(dates)==0:
             dates = self.tDate
-        fig, ax = self.SIRmodel.plotres(dpi, dates)
+        self.SIRmodel.y0 = [self.SIRmodel.N, 1, 0]
+        fig, ax = self.SIRmodel.plotres(dpi, self.dates_to_days(dates))
         return fig, ax
     
     def plotres_predicted(self, dpi=300, nDays=0):
-        fig, ax = self.plotres(dpi, self.dates_to_days(self.extend_date(self.tDate, nDays)))
+        fig, ax = self.plotres(dpi, self.extend_date(self.tDate, nDays))
+        return fig, ax
+
+def fit_params(model, IC, warmParams=None):
+    if warmParams is not None:
+        try:
+            return model.opt_curvefit(warmParams)
+        except RuntimeError as err:
+            logger.warning("Warm start of country '" + model.country + "' did not converge: " + repr(err))
+    if IC is None:
+        return model.opt_global()
+    return model.opt_curvefit(IC)
+
+def fit_country(model, IC, warmParams=None, instrumented=False):
+    # Defined at module level so that worker processes can run it, their stats are sent back with the parameters
+    instrumentation.enable(instrumented)
+    try:
+        with model.stats.timer('fit'):
+            params = fit_params(model, IC, warmParams)
+        return model.country, params, model.paramsCov, None, model.stats
+    except Exception as err:
+        return model.country, None, None, repr(err), model.stats
+
+def backtest_chunk(model, cutoffs, horizon, IC, warmParams=None, instrumented=False):
+    """
+    Fitting of model at each cutoff of a chunk, the data after the cutoff being unknown, then forecast of the next horizon days
+    Each fit starts from the parameters of the previous cutoff, the first one from warmParams or else from IC or the global search;
+    warmParams must only be known from the data until the first cutoff. The forecasts of the whole chunk are simulated in one batch
+    Defined at module level so that worker processes can run it
+    Returns the country, the cutoffs, the forecast errors shaped (n_cutoffs, horizon) - NaN where unknown - and the stats
+    """
+    instrumentation.enable(instrumented)
+    stats = Stats()
+    params = np.full((len(cutoffs), 2), np.nan)
+    for idxCutoff, cutoff in enumerate(cutoffs):
+        cutoffModel = model.until(cutoff)
+        cutoffModel.set_stats(stats)
+        try:
+            with stats.timer('backtest_fit'):
+                params[idxCutoff] = fit_params(cutoffModel, IC, warmParams)
+            warmParams = params[idxCutoff]
+        except Exception as err:
+            logger.warning("Backtest fit of country '" + model.country + "' at cutoff " + str(cutoff) + " failed: " + repr(err))
+    errors = np.full((len(cutoffs), horizon), np.nan)
+    fitted = np.flatnonzero(np.all(np.isfinite(params), axis=1))
+    if len(fitted) > 0:
+        nDays = min(max(cutoffs) + horizon, len(model.data))
+        N = model.SIRmodel.N
+        with np.errstate(over='ignore', invalid='ignore'):
+            res = simulate_batch(model.dates_to_days(range(nDays)), N, params[fitted, 0], params[fitted, 1], [N, 1, 0])
+        stats.count('batch_simulations', len(fitted))
+        for idxRes, idxCutoff in enumerate(fitted):
+            cutoff = cutoffs[idxCutoff]
+            known = min(horizon, nDays - cutoff)
+            errors[idxCutoff, 0:known] = res[idxRes, 1, cutoff:cutoff+known] - model.data[cutoff:cutoff+known]
+    return model.country, cutoffs, errors, stats
+
+def use_headless_backend():
+    # Initializer of the rendering processes, figures are only drawn to files
+    # Switching backend closes all the figures, so it is only done once
+    import matplotlib.pyplot as plt
+    if plt.get_backend().lower() != 'agg':
+        plt.switch_backend('Agg')
+
+def figure_path(folder, country, kind, fmt='png'):
+    return os.path.join(folder, re.sub(r'[^\w\-]+', '_', country) + '_' + kind + '.' + fmt)
+
+def render_figure(model, kind, nDays, dpi, path, quantiles=(0.05, 0.95), nDraws=1000):
+    # Defined at module level so that worker processes can run it, figures are drawn with the headless backend Agg
+    import matplotlib.pyplot as plt
+    use_headless_backend()
+    try:
+        if kind == 'reference':
+            fig, ax = model.plot_compare_reference(dpi)
+        elif kind == 'prediction':
+            fig, ax = model.plot_prediction(nDays, dpi, quantiles, nDraws)
+        elif kind == 'res_predicted':
+            fig, ax = model.plotres_predicted(dpi, nDays)
+        else:
+            return path, "Unknown kind of figure '" + kind + "'"
+        try:
+            fig.savefig(path, dpi=dpi)
+        finally:
+            plt.close(fig)
+    except Exception as err:
+        return path, repr(err)
+    return path, None
+
+class SIRfitStore(object):
+    """
+    Fitted parameters of the countries, each stored with the fingerprint of the data it was fitted on
+    With a path, the store is read from and saved to a json file
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.fits = {}
+        if path is not None and os.path.isfile(path):
+            try:
+                with open(path, 'r') as infile:
+                    self.fits = json.load(infile)
+            except (OSError, ValueError) as err:
+                logger.warning("Impossible to read fit store " + path + ", it will be rebuilt: " + str(err))
+    
+    def get(self, country):
+        return self.fits.get(country)
+    
+    def update(self, country, fingerprint, params, paramsCov=None):
+        fit = {'fingerprint' : fingerprint, 'params' : [float(p) for p in params]}
+        if paramsCov is not None:
+            fit.update({'cov' : [[float(c) for c in row] for row in paramsCov]})
+        self.fits.update({country : fit})
+    
+    def save(self):
+        if self.path is None:
+            return
+        tmpPath = self.path + '.tmp'
+        with open(tmpPath, 'w') as outfile:
+            json.dump(self.fits, outfile, indent=1)
+        os.replace(tmpPath, self.path)
 
 class SIRmodelFITset(object):
-    def __init__(self, countriesDataConfirmed, countryPops, IC=None):
+    def __init__(self, countriesDataConfirmed, countryPops, IC=None, fitStore=None):
         if countryPops==[]:
-            print("ERROR: Numbers of populations cannot be corresponding to zero!")
-            pass
-        if IC==None:
-            print("ERROR: Invalid Initial Conditions!")
+            logger.error("Numbers of populations cannot be corresponding to zero!")
             pass
+        # Without initial conditions, every country is initialized by a global search (SIRmodelFIT.opt_global)
         self.IC = IC
+        self.fitStore = fitStore if fitStore is not None else SIRfitStore()
+        self.fitErrors = {}
+        self.backtestErrors = {}
+        self.fastEstimates = {}
+        self.set_data(countriesDataConfirmed, countryPops)
+    
+    def set_data(self, countriesDataConfirmed, countryPops):
+        # Models are rebuilt on new data, their fits restart from the parameters kept in fitStore
         self.modelsSet = {}
         for country in countriesDataConfirmed.keys():
             self.modelsSet.update({country : SIRmodelFIT(countriesDataConfirmed, countryPops, country)})
     
-    def opt_curve_fit(self):
-        for country in self.modelsSet.keys():
-            self.modelsSet[country].opt_curvefit(self.IC)
+    def opt_fast(self, infectiousDays=7, minCases=10, window=14, maxShare=0.5, minPoints=3, setParams=True):
+        """
+        Closed-form estimate of all the countries at once, no ODE is solved
+        - The growth rate is the slope of a log-linear regression of the confirmed cases over their early exponential phase:
+          at most window days from the first day with minCases cases, while the cases are below maxShare of their maximum
+        - gamma is 1/infectiousDays; since the infected people grow early as exp((beta - gamma)*t), beta = growth + gamma
+        Countries with less than minPoints days in their early phase, or without growth, get NaN
+        Estimates are kept in fastEstimates and start the fits of opt_curve_fit(fastStart=True);
+        with setParams, they also become the parameters of the countries not fitted yet
+        Returns a table per country: growth rate, doubling time, beta, gamma, R0 and number of regression points
+        """
+        import pandas as pd
+        countries = list(self.modelsSet.keys())
+        nDays = max([len(model.data) for model in self.modelsSet.values()] + [0])
+        data = np.full((len(countries), nDays), np.nan)
+        for idxCountry, country in enumerate(countries):
+            modelData = self.modelsSet[country].data
+            data[idxCountry, 0:len(modelData)] = modelData
+        days = np.arange(nDays, dtype=float)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            started = data >= minCases
+            firstDay = np.where(started.any(axis=1), started.argmax(axis=1), nDays)
+            peak = np.max(np.where(np.isnan(data), -np.inf, data), axis=1)
+            weights = (started & (days < firstDay[:, None] + window) & (data <= maxShare * peak[:, None])).astype(float)
+            logData = np.log(np.where(weights > 0, data, 1))
+            # Least squares slope of every row at once, with the early phase as weights
+            n = weights.sum(axis=1)
+            sx, sy = weights @ days, np.sum(weights * logData, axis=1)
+            sxx, sxy = weights @ days**2, np.sum(weights * logData * days, axis=1)
+            growth = (n*sxy - sx*sy) / (n*sxx - sx**2)
+        growth[(n < minPoints) | ~(growth > 0)] = np.nan
+        gamma = 1 / infectiousDays
+        beta = growth + gamma
+        table = pd.DataFrame({'growth' : growth,
+                              'doubling_days' : np.log(2) / growth,
+                              'beta' : beta,
+                              'gamma' : np.where(np.isnan(growth), np.nan, gamma),
+                              'R0' : beta / gamma,
+                              'points' : n.astype(int)},
+                             index=pd.Index(countries, name='country'))
+        self.fastEstimates = {country : np.array([beta[idxCountry], gamma]) for idxCountry, country in enumerate(countries) if np.isfinite(beta[idxCountry])}
+        if setParams:
+            for country, params in self.fastEstimates.items():
+                if self.modelsSet[country].params is None and self.modelsSet[country].has_population():
+                    self.modelsSet[country].set_params(params)
+        return table
+    
+    def opt_curve_fit(self, workers=1, fastStart=False):
+        """
+        Fitting of all the countries, either serially (workers=1) or on a pool of worker processes (workers=None uses all the cores)
+        Countries whose data did not change since their last fit in fitStore reuse its parameters,
+        countries with changed data are refitted starting from them
+        With fastStart, countries never fitted start from their opt_fast estimate instead of IC or the global search
+        Countries whose fitting fails, or without population, are reported in fitErrors and keep their previous parameters
+        """
+        if fastStart and len(self.fastEstimates) == 0:
+            self.opt_fast(setParams=False)
+        self.fitErrors = {}
+        models, warmParams, fingerprints = [], [], {}
+        for country, model in self.modelsSet.items():
+            if not model.has_population():
+                logger.error("Country '" + country + "' has no population, it is not fitted")
+                self.fitErrors.update({country : "No population known"})
+                continue
+            fingerprints.update({country : model.fingerprint()})
+            storedFit = self.fitStore.get(country)
+            if storedFit is None:
+                models.append(model)
+                warmParams.append(self.fastEstimates.get(country) if fastStart else None)
+            elif storedFit['fingerprint'] == fingerprints[country]:
+                model.set_params(storedFit['params'], storedFit.get('cov'))
+            else:
+                models.append(model)
+                warmParams.append(storedFit['params'])
+        instrumented = instrumentation.is_enabled()
+        if workers == 1 or len(models) < 2:
+            results = [fit_country(model, self.IC, params, instrumented) for model, params in zip(models, warmParams)]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(fit_country, models, repeat(self.IC), warmParams, repeat(instrumented)))
+        for country, params, paramsCov, err, stats in results:
+            self.modelsSet[country].set_stats(stats)
+            if err is None:
+                self.modelsSet[country].set_params(params, paramsCov)
+                self.fitStore.update(country, fingerprints[country], params, paramsCov)
+            else:
+                logger.error("Fitting of country '" + country + "' failed: " + err)
+                self.fitErrors.update({country : err})
+        self.fitStore.save()
+        return self.fitErrors
+    
+    def fit_summary(self):
+        """
+        Cost of the fit of every country: ODE solves, RHS and jacobian evaluations, optimizer iterations, cache hits, timings
+        Counters are only collected after instrumentation.enable()
+        """
+        return {country : model.stats.summary() for country, model in self.modelsSet.items()}
+    
+    def export_results(self, folder, nDays=20, quantiles=(0.05, 0.95), nDraws=1000, fmt=None):
+        """
+        Bulk export of all the countries to folder, one file per table:
+        - sir_params: fitted beta and gamma with their standard deviations and covariance, R0, RMSE, MAE and R2 of the fit,
+          dates and fingerprint of the data, fit error and evaluation counters
+        - sir_forecasts: one row per country and day, over the data days and the nDays following them: observed cases,
+          simulated infected people, quantiles of the ensemble and a flag for the forecast days
+        The models sharing their dates are simulated in one simulate_batch call
+        fmt is 'parquet' (needs pyarrow) or 'csv', by default Parquet when pyarrow is available
+        Returns the paths of the two files
+        """
+        import pandas as pd
+        if fmt is None:
+            fmt = 'parquet' if importlib.util.find_spec('pyarrow') is not None else 'csv'
+        os.makedirs(folder, exist_ok=True)
+        groups = {}
+        for country, model in self.modelsSet.items():
+            if model.params is not None and model.has_population():
+                groups.setdefault((model.tDate[0], len(model.tDate)), []).append(country)
+        paramsRows, forecastFrames = [], []
+        for (firstDate, nData), countries in groups.items():
+            models = [self.modelsSet[country] for country in countries]
+            dates = models[0].extend_date(models[0].tDate, nDays + 1)
+            N = np.array([model.SIRmodel.N for model in models], dtype=float)
+            params = np.array([model.params for model in models], dtype=float)
+            with np.errstate(over='ignore', invalid='ignore'):
+                infected = simulate_batch(models[0].dates_to_days(dates), N, params[:, 0], params[:, 1], np.column_stack((N, np.ones(len(N)), np.zeros(len(N)))))[:, 1, :]
+            isoDates = pd.to_datetime(dates, format='%d/%m/%y')
+            for idxModel, model in enumerate(models):
+                residuals = infected[idxModel, 0:nData] - model.data
+                sst = np.sum((model.data - np.mean(model.data))**2)
+                cov = model.paramsCov if model.paramsCov is not None else np.full((2, 2), np.nan)
+                row = {'country' : model.country, 'beta' : params[idxModel, 0], 'gamma' : params[idxModel, 1],
+                       'beta_std' : np.sqrt(cov[0, 0]), 'gamma_std' : np.sqrt(cov[1, 1]), 'beta_gamma_cov' : cov[0, 1],
+                       'R0' : params[idxModel, 0] / params[idxModel, 1],
+                       'rmse' : np.sqrt(np.mean(residuals**2)), 'mae' : np.mean(np.abs(residuals)),
+                       'r2' : 1 - np.sum(residuals**2) / sst if sst > 0 else np.nan,
+                       'population' : N[idxModel], 'n_days' : nData, 'first_date' : isoDates[0], 'last_date' : isoDates[nData-1],
+                       'fingerprint' : model.fingerprint(), 'fit_error' : self.fitErrors.get(model.country)}
+                summary = model.stats.summary()
+                row.update({name : summary.get(name, 0) for name in ['fit_evals', 'optimizer_iterations', 'ode_solves']})
+                paramsRows.append(row)
+                frame = pd.DataFrame({'country' : model.country, 'date' : isoDates, 'day' : np.arange(1, len(dates) + 1),
+                                      'observed' : np.concatenate((model.data, np.full(len(dates) - nData, np.nan))),
+                                      'infected' : infected[idxModel], 'forecast' : np.arange(len(dates)) >= nData})
+                bands = model.ensemble(dates, nDraws, quantiles) if len(quantiles) > 0 else None
+                for idxQuantile, quantile in enumerate(quantiles):
+                    frame['q%g' % quantile] = np.nan if bands is None else bands[idxQuantile]
+                forecastFrames.append(frame)
+        for country, err in self.fitErrors.items():
+            if self.modelsSet[country].params is None:
+                paramsRows.append({'country' : country, 'fit_error' : err})
+        tables = {'sir_params' : pd.DataFrame(paramsRows),
+                  'sir_forecasts' : pd.concat(forecastFrames, ignore_index=True) if len(forecastFrames) > 0 else pd.DataFrame()}
+        paths = []
+        for name, table in tables.items():
+            path = os.path.join(folder, name + '.' + fmt)
+            tmpPath = path + '.tmp'
+            if fmt == 'parquet':
+                table.to_parquet(tmpPath, index=False)
+            else:
+                table.to_csv(tmpPath, index=False)
+            os.replace(tmpPath, path)
+            paths.append(path)
+        logger.info("Results of " + str(len(paramsRows)) + " countries exported to " + ', '.join(paths))
+        return paths
+    
+    def backtest(self, horizon=14, minDays=14, step=1, workers=1, chunkSize=8):
+        """
+        Rolling-origin backtest of the forecasts: every country is fitted at the cutoff days minDays, minDays+step, ...
+        knowing only the data until the cutoff, and its forecast of the next horizon days is compared to the data
+        - Consecutive cutoffs are grouped in chunks of chunkSize: the first cutoff of each chunk starts from IC or the global search,
+          the next ones from the previous cutoff. The current or stored parameters of the country are never used, since they were
+          fitted on the data being forecast
+        - With workers other than 1, the chunks of all the countries are run on a pool of processes
+        Raw errors are kept in backtestErrors as country -> (cutoffs, errors shaped (n_cutoffs, horizon))
+        Returns a table per country, indexed by the horizon in days: mean error (bias), MAE, RMSE, MAPE and number of forecasts
+        """
+        tasks = []
+        for country, model in self.modelsSet.items():
+            if not model.has_population():
+                logger.error("Country '" + country + "' has no population, it is not backtested")
+                continue
+            cutoffs = list(range(minDays, len(model.data), step))
+            for idxChunk in range(0, len(cutoffs), chunkSize):
+                tasks.append((model, cutoffs[idxChunk:idxChunk+chunkSize]))
+        logger.info("Backtesting " + str(len(self.modelsSet)) + " countries on " + str(sum(len(task[1]) for task in tasks)) + " cutoffs")
+        instrumented = instrumentation.is_enabled()
+        models, chunks = [task[0] for task in tasks], [task[1] for task in tasks]
+        if workers == 1 or len(tasks) < 2:
+            results = list(map(backtest_chunk, models, chunks, repeat(horizon), repeat(self.IC), repeat(None), repeat(instrumented)))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                results = list(pool.map(backtest_chunk, models, chunks, repeat(horizon), repeat(self.IC), repeat(None), repeat(instrumented)))
+        countryResults = {}
+        for country, cutoffs, errors, stats in results:
+            self.modelsSet[country].stats.merge(stats)
+            countryResults.setdefault(country, []).append((cutoffs, errors))
+        self.backtestErrors = {}
+        tables = {}
+        for country, chunkResults in countryResults.items():
+            cutoffs = np.concatenate([chunk[0] for chunk in chunkResults]).astype(int)
+            errors = np.vstack([chunk[1] for chunk in chunkResults])
+            self.backtestErrors.update({country : (cutoffs, errors)})
+            tables.update({country : self.error_table(self.modelsSet[country].data, cutoffs, errors)})
+        return tables
+    
+    def error_table(self, data, cutoffs, errors):
+        import pandas as pd
+        horizon = errors.shape[1]
+        # Data forecast by each error, to get the relative errors where the data are not zero
+        actual = np.full(errors.shape, np.nan)
+        for idxCutoff, cutoff in enumerate(cutoffs):
+            known = min(horizon, len(data) - cutoff)
+            actual[idxCutoff, 0:known] = data[cutoff:cutoff+known]
+        with np.errstate(divide='ignore', invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            relative = np.where(actual > 0, np.abs(errors) / actual, np.nan)
+            table = pd.DataFrame({'bias' : np.nanmean(errors, axis=0),
+                                  'mae' : np.nanmean(np.abs(errors), axis=0),
+                                  'rmse' : np.sqrt(np.nanmean(errors**2, axis=0)),
+                                  'mape' : 100 * np.nanmean(relative, axis=0),
+                                  'forecasts' : np.sum(np.isfinite(errors), axis=0)},
+                                 index=pd.RangeIndex(1, horizon + 1, name='horizon'))
+        return table
+    
+    def export_figures(self, folder, nDays=0, dpi=300, fmt='png', kinds=('prediction', 'res_predicted'), workers=1, quantiles=(0.05, 0.95), nDraws=1000):
+        """
+        Rendering of the figures of all the countries to files of folder, named <country>_<kind>.<fmt>
+        - kinds are among 'reference' (plot_compare_reference), 'prediction' (plot_prediction) and 'res_predicted' (plotres_predicted)
+        - Prediction figures shade the band between the quantiles of an ensemble of nDraws, quantiles=None draws the fit only
+        - Figures are drawn with the headless backend Agg, which becomes the backend of the calling process when workers is 1;
+          with workers other than 1, figures are rendered by a pool of processes
+        - Every figure is closed once saved; figures whose data, parameters, covariance and settings did not change are not rendered again
+        Returns the paths of the figures that could not be rendered, with their errors
+        """
+        os.makedirs(folder, exist_ok=True)
+        manifestPath = os.path.join(folder, '.figures.json')
+        manifest = {}
+        if os.path.isfile(manifestPath):
+            try:
+                with open(manifestPath, 'r') as infile:
+                    manifest = json.load(infile)
+            except (OSError, ValueError):
+                manifest = {}
+        jobs, fingerprints, renderErrors = [], {}, {}
+        for country, model in self.modelsSet.items():
+            for kind in kinds:
+                path = figure_path(folder, country, kind, fmt)
+                if not model.has_population():
+                    logger.error("Rendering of figure " + path + " skipped, country '" + country + "' has no population")
+                    renderErrors.update({path : "No population known"})
+                    continue
+                params = None if model.params is None else [float(p) for p in model.params]
+                # The band of the prediction figures depends on the covariance of the parameters and on the ensemble settings
+                bandSettings = None
+                if kind == 'prediction':
+                    bandSettings = (None if model.paramsCov is None else [float(c) for c in model.paramsCov.ravel()],
+                                    None if quantiles is None else [float(q) for q in quantiles], nDraws)
+                settings = repr((model.fingerprint(), params, bandSettings, kind, nDays, dpi, fmt))
+                fingerprints.update({path : hashlib.sha1(settings.encode()).hexdigest()})
+                if os.path.isfile(path) and manifest.get(os.path.basename(path)) == fingerprints[path]:
+                    continue
+                jobs.append((model, kind, path))
+        logger.info("Rendering " + str(len(jobs)) + " figures to " + folder + ", " + str(len(fingerprints) - len(jobs)) + " are up to date")
+        models, jobKinds, paths = [job[0] for job in jobs], [job[1] for job in jobs], [job[2] for job in jobs]
+        if workers == 1 or len(jobs) < 2:
+            results = list(map(render_figure, models, jobKinds, repeat(nDays), repeat(dpi), paths, repeat(quantiles), repeat(nDraws)))
+        else:
+            with ProcessPoolExecutor(max_workers=workers, initializer=use_headless_backend) as pool:
+                results = list(pool.map(render_figure, models, jobKinds, repeat(nDays), repeat(dpi), paths, repeat(quantiles), repeat(nDraws)))
+        for path, err in results:
+            if err is None:
+                manifest.update({os.path.basename(path) : fingerprints[path]})
+            else:
+                logger.error("Rendering of figure " + path + " failed: " + err)
+                manifest.pop(os.path.basename(path), None)
+                renderErrors.update({path : err})
+        with open(manifestPath, 'w') as outfile:
+            json.dump(manifest, outfile, indent=1)
+        return renderErrors
     
     def plot_compare_reference(self, dpi=300):
         for country in self.modelsSet.keys():
@@ -200,7 +960,7 @@ class SIRmodelFITset(object):
             
     def plot_prediction(self, dpi=300, nDays=0):
         if nDays==0:
-            print("WARNING: Number of days to predict either not specified or zero! No days will be predicted")
+            logger.warning("Number of days to predict either not specified or zero! No days will be predicted")
         for country in self.modelsSet.keys():
             self.modelsSet[country].plot_prediction(nDays, dpi)
             
@@ -210,6 +970,6 @@ class SIRmodelFITset(object):
             
     def plotres_predicted(self, dpi=300, nDays=0):
         if nDays==0:
-            print("WARNING: Number of days to predict either not specified or zero! No days will be predicted")
+            logger.warning("Number of days to predict either not specified or zero! No days will be predicted")
         for country in self.modelsSet.keys():
             self.modelsSet[country].plotres_predicted(dpi, nDays)
\ No newline at end of file
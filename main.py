@@ -7,48 +7,159 @@ Data is downloaded:
     - By direct downloading the file https://population.un.org/wpp/Download/Files/1_Indicators%20(Standard)/CSV_FILES/WPP2019_TotalPopulationBySex.csv for the number of people in populations
 
 An alternative way to load data offline is possible:
-    - By providing full paths of csv files as an argument of HDXdata()
-    - By placing the file WPP2019_TotalPopulationBySex.csv in the working directory
+    - By placing the HDX csv files and the file WPP2019_TotalPopulationBySex.csv in the data directory
 
 Data is managed with the module data_manager, then analyzed with the module lib_sir_model
+
+Usage:
+    python main.py fetch                              downloads the files and builds their caches
+    python main.py fit Italy Germany                  fits the countries, parameters are kept in sir_fits.json
+    python main.py predict Italy --days 20            prints the prediction of the next 20 days, from the kept fit if the data did not change
+    python main.py plot Italy --days 20 --output figures
+    python main.py pipeline Italy Germany --days 20   fits and renders every country as soon as its data are ready (see pipeline)
+    python main.py serve --port 8000                  keeps data and fits in memory and answers over HTTP (see forecast_service)
+Without countries, the countries of the original analysis are used
+Modules are imported only by the commands needing them: predict from cached data and kept fits does not import SciPy nor matplotlib
 """
 
 import os
-os.chdir( os.getcwd() )
-import data_manager as dtmg
-import lib_sir_model as sir
-
-# Loading data
-data = dtmg.HDXdata()
-popData = dtmg.POPdata()
-
-# Interesting countries (It is possible to add others to the list)
-ita = 'Italy'
-deu = 'Germany'
-usa = 'US'
-eng = 'United Kingdom'
-esp = 'Spain'
-ned = 'Netherlands'
-fra = 'France'
-
-# Ordering countries' data
-data.add_countriesNames(ita, deu, usa, eng, esp, ned, fra)
-data.load_parse_all_countries()
-
-# Getting data
-pops = popData.get_pop_countries(ita, deu, usa, eng, esp, ned, fra)
-confirmed = data.get_countries_confirmed()  # Corresponding to Infected
-#recovered = data.get_countries_recovered()  # Corresponding to Recovered
-
-# Fitting models
-IC = (0, 0)
-setSIRmodels = sir.SIRmodelFITset(confirmed, pops, IC)
-setSIRmodels.opt_curve_fit()
-
-# Plotting results for N days
-dpi = 600
-N = 20
-#setSIRmodels.plot_compare_reference(dpi)
-setSIRmodels.plot_prediction(dpi, N)
-#setSIRmodels.plotres(dpi)
-setSIRmodels.plotres_predicted(dpi, N)
\ No newline at end of file
+import sys
+import argparse
+
+defaultCountries = ['Italy', 'Germany', 'US', 'United Kingdom', 'Spain', 'Netherlands', 'France']
+
+def load_data(args):
+    import data_manager as dtmg
+    csvPaths = dtmg.local_hdx_csvs(args.data_dir)
+    data = dtmg.HDXdata(csvPaths, dataDir=args.data_dir, aggregate=args.aggregate)
+    popData = dtmg.POPdata(dataDir=args.data_dir, load=False)
+    if len(csvPaths) == 0:
+        dtmg.fetch_sources(data, popData)
+    popData.load()
+    countries = args.countries if len(args.countries) > 0 else defaultCountries
+    data.add_countriesNames(*countries)
+    data.load_parse_all_countries()
+    return data, popData, countries
+
+def load_models(args):
+    # Countries whose data did not change reuse the parameters of the fit store, the others are fitted
+    import lib_sir_model as sir
+    data, popData, countries = load_data(args)
+    pops = popData.get_pop_countries(*countries)
+    confirmed = data.get_countries_confirmed()
+    setSIRmodels = sir.SIRmodelFITset(confirmed, pops, None, sir.SIRfitStore(args.store))
+    setSIRmodels.opt_curve_fit(args.workers)
+    return setSIRmodels
+
+def command_fetch(args):
+    # Fails if any file could not be downloaded, even when its previous copy is kept
+    import data_manager as dtmg
+    data = dtmg.HDXdata(dataDir=args.data_dir)
+    popData = dtmg.POPdata(dataDir=args.data_dir, load=False)
+    hdxResults, popResult = dtmg.fetch_sources(data, popData, args.delta)
+    # Caches of the HDX files and index of the populations are built now, later commands only read them
+    data.load_csvs()
+    popData.load()
+    return 1 if None in hdxResults or popResult is None or len(popData.popIndex) == 0 else 0
+
+def command_fit(args):
+    setSIRmodels = load_models(args)
+    for country, model in setSIRmodels.modelsSet.items():
+        if model.params is not None:
+            print("%s: beta=%g gamma=%g" % (country, model.params[0], model.params[1]))
+    return 1 if len(setSIRmodels.fitErrors) > 0 else 0
+
+def command_predict(args):
+    """
+    Prediction of the infected people as csv lines: country, date, value, then the quantiles if asked
+    The fitted model is simulated with simulate_batch, the quantiles come from its ensemble
+    """
+    setSIRmodels = load_models(args)
+    header = ['country', 'date', 'infected'] + ['q%g' % quantile for quantile in args.quantiles]
+    print(','.join(header))
+    for country, model in setSIRmodels.modelsSet.items():
+        if model.params is None:
+            continue
+        dates, prediction, bands = model.forecast(args.days, args.quantiles, args.draws)
+        for idxDate, date in enumerate(dates):
+            values = [prediction[idxDate]] + ([] if bands is None else list(bands[:, idxDate]))
+            print(','.join([country, date] + ['%.1f' % value for value in values]))
+    return 0
+
+def command_plot(args):
+    setSIRmodels = load_models(args)
+    renderErrors = setSIRmodels.export_figures(args.output, args.days, args.dpi, args.format, args.kinds, args.workers)
+    return 1 if len(renderErrors) > 0 else 0
+
+def command_pipeline(args):
+    import pipeline
+    countries = args.countries if len(args.countries) > 0 else defaultCountries
+    pipe = pipeline.Pipeline(countries, args.data_dir, args.output, args.store, None, args.days, args.dpi, args.format, args.kinds,
+                             args.workers, args.render_workers, args.queue_size, args.aggregate)
+    results = pipe.run()
+    for country, params in results['params'].items():
+        print("%s: beta=%g gamma=%g" % (country, params[0], params[1]))
+    return 1 if len(results['errors']) > 0 else 0
+
+def command_serve(args):
+    import forecast_service
+    forecast_service.serve(forecast_service.ForecastService(args.data_dir, args.store, args.aggregate), args.host, args.port)
+    return 0
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Fitting of COVID-19 data with SIR models")
+    parser.add_argument('--data-dir', default=os.getcwd(), help="folder of the HDX and WPP files")
+    parser.add_argument('--verbose', action='store_true', help="show every message of the libraries")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    fetch = subparsers.add_parser('fetch', help="download the data and build their caches")
+    fetch.add_argument('--delta', action='store_true', help="append only the new dates to the caches")
+    fetch.set_defaults(run=command_fetch)
+
+    serve = subparsers.add_parser('serve', help="serve forecasts and fitted parameters over HTTP")
+    serve.add_argument('--store', default='sir_fits.json', help="json file of the fitted parameters")
+    serve.add_argument('--aggregate', action='store_true', help="sum the provinces of the countries")
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8000)
+    serve.set_defaults(run=command_serve)
+
+    for name, run, helpText in [('fit', command_fit, "fit the countries"),
+                                ('predict', command_predict, "print the predictions of the countries"),
+                                ('plot', command_plot, "render the figures of the countries to files"),
+                                ('pipeline', command_pipeline, "fit and render the countries in a pipeline")]:
+        command = subparsers.add_parser(name, help=helpText)
+        command.add_argument('countries', nargs='*', help="countries to analyze")
+        command.add_argument('--store', default='sir_fits.json', help="json file of the fitted parameters")
+        command.add_argument('--workers', type=int, default=1, help="worker processes used for fitting and plotting")
+        command.add_argument('--aggregate', action='store_true', help="sum the provinces of the countries")
+        command.set_defaults(run=run)
+        if name in ['predict', 'plot', 'pipeline']:
+            command.add_argument('--days', type=int, default=20, help="number of days to predict")
+        if name == 'predict':
+            command.add_argument('--quantiles', type=float, nargs='*', default=[], help="quantiles of the ensemble to print, e.g. 0.05 0.95")
+            command.add_argument('--draws', type=int, default=1000, help="number of draws of the ensemble")
+        if name == 'pipeline':
+            command.add_argument('--render-workers', type=int, default=1, help="worker processes used for rendering")
+            command.add_argument('--queue-size', type=int, default=8, help="countries waiting between two stages")
+        if name in ['plot', 'pipeline']:
+            command.add_argument('--output', default='figures', help="folder of the figures")
+            command.add_argument('--dpi', type=int, default=300)
+            command.add_argument('--format', default='png')
+            command.add_argument('--kinds', nargs='+', default=['prediction', 'res_predicted'], choices=['reference', 'prediction', 'res_predicted'])
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    import logging
+    import instrumentation
+    import data_manager as dtmg
+    args = parse_args(argv)
+    # Messages of the libraries go to stderr, predictions to stdout
+    instrumentation.setup_logging(logging.DEBUG if args.verbose else logging.INFO)
+    try:
+        return args.run(args)
+    except dtmg.DownloadError as err:
+        logging.getLogger(__name__).error(str(err))
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
\ No newline at end of file
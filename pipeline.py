@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+Pipelined analysis of a list of countries: download -> parse -> fit -> render
+- The HDX files and the WPP file are downloaded and loaded at the same time, each by its own thread
+- Every country is parsed as soon as the HDX data are loaded, and sent to fitting as soon as the populations are known
+- Every country is rendered as soon as its fit is complete, then its model is released
+- Stages are linked by bounded queues: a slow stage holds back the previous ones instead of piling up models in memory
+- A failure is reported in the errors of its country and stage, the other countries go on; a stage whose threads all stopped
+  does not hold back the previous ones
+
+Example:
+    pipe = Pipeline(['Italy', 'Germany', 'Spain'], outputDir='figures', fitWorkers=4)
+    results = pipe.run()
+"""
+
+import os
+import time
+import queue
+import logging
+import threading
+from concurrent.futures import ProcessPoolExecutor
+import data_manager as dtmg
+import lib_sir_model as sir
+import instrumentation
+from instrumentation import Stats
+
+logger = logging.getLogger(__name__)
+
+class Pipeline(object):
+    def __init__(self, countries, dataDir=None, outputDir='figures', storePath='sir_fits.json', IC=None, nDays=20, dpi=300,
+                 fmt='png', kinds=('prediction', 'res_predicted'), fitWorkers=1, renderWorkers=1, queueSize=8, aggregate=False):
+        self.countries = list(countries)
+        self.dataDir = dataDir if dataDir is not None else os.getcwd()
+        self.outputDir = outputDir
+        self.fitStore = sir.SIRfitStore(storePath)
+        self.IC = IC
+        self.nDays = nDays
+        self.dpi = dpi
+        self.fmt = fmt
+        self.kinds = kinds
+        # fitWorkers and renderWorkers are threads of the stages, with more than one they hand their work to pools of processes
+        self.fitWorkers = fitWorkers
+        self.renderWorkers = renderWorkers
+        self.queueSize = queueSize
+        self.aggregate = aggregate
+        self.stats = Stats()
+
+    def run(self):
+        """
+        Running all the stages until every country is rendered
+        Figures are drawn with the headless backend Agg, which becomes the backend of the calling process
+        Returns a dictionary with the parameters of the countries, the errors of every stage
+        and the latency of every country, from the start of the pipeline to the end of its rendering
+        """
+        os.makedirs(self.outputDir, exist_ok=True)
+        sir.use_headless_backend()
+        self.start = time.perf_counter()
+        self.params, self.errors, self.latencies = {}, {}, {}
+        self.resultsLock = threading.Lock()
+        self.storeLock = threading.Lock()
+        self.hdxReady, self.popReady = threading.Event(), threading.Event()
+        self.fitQueue = queue.Queue(self.queueSize)
+        self.renderQueue = queue.Queue(self.queueSize)
+        self.fitPool = ProcessPoolExecutor(self.fitWorkers) if self.fitWorkers > 1 else None
+        self.renderPool = ProcessPoolExecutor(self.renderWorkers, initializer=sir.use_headless_backend) if self.renderWorkers > 1 else None
+        self.fittersLeft, self.renderersLeft = self.fitWorkers, self.renderWorkers
+        self.data, self.popData = None, None
+        threads = [threading.Thread(target=self.load_hdx), threading.Thread(target=self.load_pop), threading.Thread(target=self.parse)]
+        threads += [threading.Thread(target=self.fit) for idx in range(self.fitWorkers)]
+        threads += [threading.Thread(target=self.render) for idx in range(self.renderWorkers)]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            # Models left in a queue whose stage stopped were never processed
+            for stage, stageQueue in [('fit', self.fitQueue), ('render', self.renderQueue)]:
+                while not stageQueue.empty():
+                    model = stageQueue.get()
+                    if model is not None:
+                        self.add_error(model.country, stage, "Stage stopped")
+        finally:
+            for pool in [self.fitPool, self.renderPool]:
+                if pool is not None:
+                    pool.shutdown()
+            self.fitStore.save()
+        logger.info("Pipeline of " + str(len(self.countries)) + " countries completed in %.2f s, %d errors" % (time.perf_counter() - self.start, len(self.errors)))
+        return {'params' : self.params, 'errors' : self.errors, 'latencies' : self.latencies, 'stats' : self.stats.summary()}
+
+    def add_error(self, country, stage, err):
+        logger.error("Stage " + stage + " of country '" + country + "' failed: " + err)
+        with self.resultsLock:
+            self.errors.update({country : stage + ': ' + err})
+    
+    def add_errors(self, countries, stage, err):
+        for country in countries:
+            self.add_error(country, stage, err)
+    
+    def put(self, stageQueue, item, consumersLeft):
+        # Blocks while the next stage is busy; returns False once all the threads of the next stage have stopped
+        while True:
+            try:
+                stageQueue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                with self.resultsLock:
+                    if consumersLeft() == 0:
+                        return False
+
+    def load_hdx(self):
+        # self.data is set only once the data are loaded: after any failure parse finds None and reports every country
+        try:
+            with self.stats.timer('load_hdx'):
+                csvPaths = dtmg.local_hdx_csvs(self.dataDir)
+                data = dtmg.HDXdata(csvPaths, dataDir=self.dataDir, aggregate=self.aggregate)
+                if len(csvPaths) == 0:
+                    data.download()
+                data.load_csvs()
+            self.data = data
+        except Exception as err:
+            self.add_error('*', 'load_hdx', repr(err))
+        finally:
+            self.hdxReady.set()
+
+    def load_pop(self):
+        try:
+            with self.stats.timer('load_pop'):
+                popData = dtmg.POPdata(dataDir=self.dataDir, load=False)
+                popData.load()
+            self.popData = popData
+        except Exception as err:
+            self.add_error('*', 'load_pop', repr(err))
+        finally:
+            self.popReady.set()
+
+    def parse(self):
+        # Countries enter the fitting stage one by one; put blocks while the fitting stage is busy
+        # When a loading stage failed, every country not sent yet gets an error: the run is never reported clean
+        idx = 0
+        try:
+            self.hdxReady.wait()
+            if self.data is None:
+                self.add_errors(self.countries, 'load_hdx', "HDX data not loaded")
+                return
+            store = self.data.get_store()
+            for idx, country in enumerate(self.countries):
+                countryView = store.country_view(country, self.aggregate)
+                if countryView is None:
+                    self.add_error(country, 'parse', "No data")
+                    continue
+                confirmed = dtmg.ParsedDataCountry(countryView).allValues['confirmed']
+                self.popReady.wait()
+                if self.popData is None:
+                    self.add_errors(self.countries[idx:], 'load_pop', "Populations not loaded")
+                    return
+                try:
+                    model = sir.SIRmodelFIT({country : confirmed}, {country : self.popData.get_pop_country(country)}, country)
+                except Exception as err:
+                    self.add_error(country, 'parse', repr(err))
+                    continue
+                if not self.put(self.fitQueue, model, lambda: self.fittersLeft):
+                    self.add_error(country, 'fit', "Fitting stage stopped")
+        except Exception as err:
+            self.add_errors(self.countries[idx:], 'parse', repr(err))
+        finally:
+            for idx in range(self.fitWorkers):
+                self.put(self.fitQueue, None, lambda: self.fittersLeft)
+
+    def fit(self):
+        instrumented = instrumentation.is_enabled()
+        try:
+            while True:
+                model = self.fitQueue.get()
+                if model is None:
+                    return
+                try:
+                    if not self.fit_model(model, instrumented):
+                        continue
+                except Exception as err:
+                    # e.g. a country without population, or a broken pool of processes
+                    self.add_error(model.country, 'fit', repr(err))
+                    continue
+                if not self.put(self.renderQueue, model, lambda: self.renderersLeft):
+                    self.add_error(model.country, 'render', "Rendering stage stopped")
+        finally:
+            # The last fitting thread to stop closes the rendering stage
+            with self.resultsLock:
+                self.fittersLeft -= 1
+                lastFitter = self.fittersLeft == 0
+            if lastFitter:
+                for idx in range(self.renderWorkers):
+                    self.put(self.renderQueue, None, lambda: self.renderersLeft)
+    
+    def fit_model(self, model, instrumented):
+        # Returns False if the fitting failed, its error being reported
+        fingerprint = model.fingerprint()
+        with self.storeLock:
+            storedFit = self.fitStore.get(model.country)
+        if storedFit is not None and storedFit['fingerprint'] == fingerprint:
+            model.set_params(storedFit['params'], storedFit.get('cov'))
+        else:
+            warmParams = None if storedFit is None else storedFit['params']
+            if self.fitPool is not None:
+                country, params, paramsCov, err, stats = self.fitPool.submit(sir.fit_country, model, self.IC, warmParams, instrumented).result()
+            else:
+                country, params, paramsCov, err, stats = sir.fit_country(model, self.IC, warmParams, instrumented)
+            with self.resultsLock:
+                self.stats.merge(stats)
+            if err is not None:
+                self.add_error(country, 'fit', err)
+                return False
+            model.set_params(params, paramsCov)
+            with self.storeLock:
+                self.fitStore.update(country, fingerprint, params, paramsCov)
+        with self.resultsLock:
+            self.params.update({model.country : [float(p) for p in model.params]})
+        return True
+
+    def render(self):
+        try:
+            while True:
+                model = self.renderQueue.get()
+                if model is None:
+                    return
+                for kind in self.kinds:
+                    try:
+                        path = sir.figure_path(self.outputDir, model.country, kind, self.fmt)
+                        if self.renderPool is not None:
+                            path, err = self.renderPool.submit(sir.render_figure, model, kind, self.nDays, self.dpi, path).result()
+                        else:
+                            path, err = sir.render_figure(model, kind, self.nDays, self.dpi, path)
+                    except Exception as renderErr:
+                        # e.g. a broken pool of processes
+                        err = repr(renderErr)
+                    if err is not None:
+                        self.add_error(model.country, 'render', err)
+                with self.resultsLock:
+                    self.latencies.update({model.country : time.perf_counter() - self.start})
+        finally:
+            with self.resultsLock:
+                self.renderersLeft -= 1
\ No newline at end of file
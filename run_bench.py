@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark of the data and SIR libraries on synthetic data
+
+Each scale (number of regions x number of days) is generated with the module synthetic_data, then the stages are timed separately:
+    - Loading and parsing of the HDX files with HDXdata, from the csv files and from their cache
+    - Building, loading and querying the populations' index of POPdata
+    - Simulation of one SIR model per region, with SIRmodel.simulate and with simulate_batch
+    - Fitting of a subset of the regions with SIRmodelFITset.opt_curve_fit, with the counters of its fit_summary
+    - Plotting of the predictions of a subset of the regions
+    - Pipeline from the files to the figures of the same subset, with an empty fit store
+    - Prediction of one region by the command line of main.py, from the caches and a kept fit, in a new interpreter
+The import time of every module is measured once, each in a new interpreter
+Results are written to a json file, to be compared across commits
+
+Example: python run_bench.py --regions 10 100 1000 --days 30 365 --output bench_results.json
+"""
+
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import datetime
+import platform
+import tempfile
+import subprocess
+import contextlib
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import pandas as pd
+
+import data_manager as dtmg
+import lib_sir_model as sir
+import synthetic_data as synth
+import pipeline
+import instrumentation
+
+repoDir = os.path.dirname(os.path.abspath(__file__))
+
+def timed(stages, name, fun, items=1):
+    # Console output of the libraries is discarded, its cost is still part of the timing
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        res = fun()
+        seconds = time.perf_counter() - start
+    stages.update({name : {'seconds' : seconds, 'items' : items, 'seconds_per_item' : seconds / max(items, 1)}})
+    print("  %-24s %10.4f s  (%d items)" % (name, seconds, items))
+    return res
+
+def run_scale(folder, nRegions, nDays, nFit, nPlot, workers):
+    stages = {}
+    csvPaths = synth.write_hdx_csvs(folder, nRegions, nDays)
+    countries = list(dict.fromkeys(pd.read_csv(csvPaths[0], usecols=['Country/Region'])['Country/Region']))
+    synth.write_wpp_csv(folder, countries)
+
+    def load_parse(useCache):
+        data = dtmg.HDXdata(csvPaths, useCache=useCache)
+        data.add_countriesNames(*countries)
+        data.load_parse_all_countries()
+        return data
+    timed(stages, 'hdx_load_parse_csv', lambda: load_parse(False), len(countries))
+    timed(stages, 'hdx_build_cache', lambda: load_parse(True), len(countries))
+    data = timed(stages, 'hdx_load_parse_cache', lambda: load_parse(True), len(countries))
+
+    timed(stages, 'pop_build_index', lambda: dtmg.POPdata(dataDir=folder), len(countries))
+    popData = timed(stages, 'pop_load_index', lambda: dtmg.POPdata(dataDir=folder), len(countries))
+    pops = timed(stages, 'pop_lookup', lambda: popData.get_pop_countries(*countries), len(countries))
+
+    confirmed = data.get_countries_confirmed()
+    tDays = np.linspace(1, nDays, nDays)
+    N = np.array([pops[country] for country in countries])
+    betas = np.random.default_rng(0).uniform(0.1, 0.5, len(countries))
+    def simulate():
+        for idx in range(len(countries)):
+            sir.SIRmodel(N[idx], betas[idx], 0.1).simulate(tDays, [N[idx], 1, 0])
+    timed(stages, 'sir_simulate', simulate, len(countries))
+    timed(stages, 'sir_simulate_batch', lambda: sir.simulate_batch(tDays, N, betas, 0.1, np.column_stack((N, np.ones(len(N)), np.zeros(len(N))))), len(countries))
+
+    fitCountries = countries[0:nFit]
+    setSIRmodels = sir.SIRmodelFITset({country : confirmed[country] for country in fitCountries}, pops)
+    timed(stages, 'sir_fit', lambda: setSIRmodels.opt_curve_fit(workers), len(fitCountries))
+    fitCounters = {}
+    for summary in setSIRmodels.fit_summary().values():
+        for name, value in summary.items():
+            fitCounters[name] = fitCounters.get(name, 0) + value
+    stages['sir_fit'].update({'counters' : fitCounters})
+
+    def plot():
+        for country in fitCountries[0:nPlot]:
+            fig, ax = setSIRmodels.modelsSet[country].plot_prediction(20, 100)
+            fig.savefig(os.path.join(folder, country + '.png'))
+            plt.close(fig)
+    timed(stages, 'plot_prediction', plot, min(nPlot, len(fitCountries)))
+
+    pipe = pipeline.Pipeline(fitCountries[0:nPlot], folder, os.path.join(folder, 'pipeline'), os.path.join(folder, 'pipeline_fits.json'),
+                             nDays=20, dpi=100, kinds=('prediction',), fitWorkers=workers)
+    timed(stages, 'pipeline', pipe.run, min(nPlot, len(fitCountries)))
+
+    # The caches and the fit store are ready, the prediction only reads them
+    command = [sys.executable, os.path.join(repoDir, 'main.py'), '--data-dir', folder]
+    storeArgs = [countries[0], '--store', os.path.join(folder, 'sir_fits.json')]
+    subprocess.run(command + ['fit'] + storeArgs, capture_output=True, check=True, cwd=folder)
+    timed(stages, 'cli_predict', lambda: subprocess.run(command + ['predict'] + storeArgs + ['--days', '20'], capture_output=True, check=True, cwd=folder))
+    return stages
+
+def import_times(modules=('data_manager', 'lib_sir_model', 'lib_compartment_model', 'main')):
+    times = {}
+    for module in modules:
+        code = "import time; start = time.perf_counter(); import " + module + "; print(time.perf_counter() - start)"
+        res = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True, cwd=repoDir)
+        times.update({module : float(res.stdout.strip())})
+        print("  import %-21s %10.4f s" % (module, times[module]))
+    return times
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, cwd=repoDir).stdout.strip()
+    except OSError:
+        return ''
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark of data_manager and lib_sir_model on synthetic data")
+    parser.add_argument('--regions', type=int, nargs='+', default=[50], help="numbers of regions to benchmark")
+    parser.add_argument('--days', type=int, nargs='+', default=[120], help="numbers of days to benchmark")
+    parser.add_argument('--fit-regions', type=int, default=10, help="number of regions to fit at each scale")
+    parser.add_argument('--plot-regions', type=int, default=3, help="number of regions to plot at each scale")
+    parser.add_argument('--workers', type=int, default=1, help="worker processes used for fitting")
+    parser.add_argument('--output', default='bench_results.json', help="json file of the results")
+    parser.add_argument('--keep-data', action='store_true', help="keep the synthetic files")
+    args = parser.parse_args(argv)
+    instrumentation.enable()
+
+    results = {'commit' : git_commit(),
+               'date' : datetime.datetime.now().isoformat(timespec='seconds'),
+               'python' : platform.python_version(),
+               'machine' : platform.machine(),
+               'runs' : []}
+    print("Import times")
+    results.update({'imports' : import_times()})
+    for nRegions in args.regions:
+        for nDays in args.days:
+            print("Benchmark of " + str(nRegions) + " regions over " + str(nDays) + " days")
+            folder = tempfile.mkdtemp(prefix='covidata_bench_')
+            try:
+                stages = run_scale(folder, nRegions, nDays, args.fit_regions, args.plot_regions, args.workers)
+            finally:
+                if args.keep_data:
+                    print("Synthetic data kept in " + folder)
+                else:
+                    shutil.rmtree(folder, ignore_errors=True)
+            results['runs'].append({'regions' : nRegions, 'days' : nDays, 'fit_regions' : args.fit_regions,
+                                    'plot_regions' : args.plot_regions, 'workers' : args.workers, 'stages' : stages})
+    with open(args.output, 'w') as outfile:
+        json.dump(results, outfile, indent=1)
+    print("Results written to " + args.output)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
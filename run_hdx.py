@@ -8,6 +8,9 @@ import os
 os.chdir( os.getcwd() )
 
 import data_manager as dtmg
+import instrumentation
+
+instrumentation.setup_logging()
 
 #csvPaths = [os.getcwd() + "\\" + s for s in glob.glob('*.csv')]
 csvPaths = []
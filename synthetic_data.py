@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic data in the formats of the HDX and WPP files, to run the libraries offline and at any scale
+- write_hdx_csvs writes the confirmed, deaths and recovered time series of nRegions regions over nDays days
+- write_wpp_csv writes the populations of the given locations, for every year and variant
+"""
+
+import os
+import datetime
+import numpy as np
+import pandas as pd
+
+hdxNames = {'confirmed' : 'time_series_covid19_confirmed_global.csv',
+            'deaths' : 'time_series_covid19_deaths_global.csv',
+            'recovered' : 'time_series_covid19_recovered_global.csv'}
+
+def hdx_dates(nDays, firstDate=datetime.date(2020, 1, 22)):
+    # Same format as the HDX headers, e.g. 1/22/20
+    dates = [firstDate + datetime.timedelta(days=day) for day in range(nDays)]
+    return [str(date.month) + '/' + str(date.day) + '/' + date.strftime('%y') for date in dates]
+
+def region_names(nRegions, provincesShare=0.1, seed=0):
+    """
+    Names of the regions as (Province/State, Country/Region) couples
+    About provincesShare of the regions are provinces, grouped by three under the same country
+    """
+    rng = np.random.default_rng(seed)
+    regions = []
+    idxCountry = 0
+    while len(regions) < nRegions:
+        country = 'Country%04d' % idxCountry
+        idxCountry += 1
+        if rng.random() < provincesShare / 3:
+            for idxProvince in range(min(3, nRegions - len(regions))):
+                regions.append((country + ' Province%d' % idxProvince, country))
+        else:
+            regions.append(('', country))
+    return regions
+
+def write_hdx_csvs(folder, nRegions=50, nDays=120, provincesShare=0.1, seed=0):
+    """
+    Confirmed cases follow a logistic curve with random growth rate, size and peak day, plus noise
+    Deaths and recovered are delayed fractions of the confirmed cases
+    Returns the paths of the three csv files
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    regions = region_names(nRegions, provincesShare, seed)
+    days = np.arange(nDays)
+    growth = rng.uniform(0.08, 0.3, (nRegions, 1))
+    size = rng.uniform(1e3, 1e6, (nRegions, 1))
+    peak = rng.uniform(0.3, 0.9, (nRegions, 1)) * nDays
+    confirmed = size / (1 + np.exp(-growth * (days - peak)))
+    confirmed = np.maximum.accumulate(confirmed * rng.uniform(0.97, 1.03, confirmed.shape), axis=1)
+    delayed = lambda values, delay: np.hstack((np.zeros((nRegions, delay)), values[:, 0:nDays-delay]))
+    values = {'confirmed' : confirmed,
+              'deaths' : 0.05 * delayed(confirmed, min(7, nDays)),
+              'recovered' : 0.8 * delayed(confirmed, min(14, nDays))}
+    keys = pd.DataFrame({'Province/State' : [region[0] for region in regions],
+                         'Country/Region' : [region[1] for region in regions],
+                         'Lat' : rng.uniform(-60, 70, nRegions).round(4),
+                         'Long' : rng.uniform(-180, 180, nRegions).round(4)})
+    dates = hdx_dates(nDays)
+    paths = []
+    for category, filename in hdxNames.items():
+        path = os.path.join(folder, filename)
+        series = pd.DataFrame(np.floor(values[category]).astype(np.int64), columns=dates)
+        pd.concat([keys, series], axis=1).to_csv(path, index=False)
+        paths.append(path)
+    return paths
+
+def write_wpp_csv(folder, locations, years=(1950, 2100), variants=('Medium', 'High', 'Low'), seed=0):
+    """
+    Populations in thousands, one row per location, variant and year, like WPP2019_TotalPopulationBySex.csv
+    Returns the path of the csv file
+    """
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    nYears = years[1] - years[0] + 1
+    basePops = np.repeat(rng.uniform(1e2, 1e5, len(locations)), nYears)
+    frames = []
+    for idxVariant, variant in enumerate(variants):
+        pops = basePops * (1 + 0.002*idxVariant)
+        frames.append(pd.DataFrame({'LocID' : np.repeat(np.arange(len(locations)), nYears),
+                                    'Location' : np.repeat(locations, nYears),
+                                    'VarID' : idxVariant + 2,
+                                    'Variant' : variant,
+                                    'Time' : np.tile(np.arange(years[0], years[1] + 1), len(locations)),
+                                    'MidPeriod' : np.tile(np.arange(years[0], years[1] + 1), len(locations)) + 0.5,
+                                    'PopMale' : pops / 2,
+                                    'PopFemale' : pops / 2,
+                                    'PopTotal' : pops,
+                                    'PopDensity' : pops / 1e3}))
+    path = os.path.join(folder, 'WPP2019_TotalPopulationBySex.csv')
+    pd.concat(frames).to_csv(path, index=False)
+    return path
\ No newline at end of file
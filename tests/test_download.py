@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""
+Downloads of the HDX files against a local HTTP stand-in of the HDX page and of the servers of its csv files
+Run with: python -m pytest tests, or python -m unittest discover tests
+"""
+
+import os
+import sys
+import json
+import shutil
+import hashlib
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data_manager as dtmg
+import synthetic_data as synth
+import forecast_service
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # The page links the csv files of the served folder, as the HDX page does; files answer ETag, If-None-Match and Range requests
+    def do_GET(self):
+        server = self.server
+        path = urllib.parse.urlparse(self.path).path
+        if path == '/page':
+            if server.pageStatus != 200:
+                self.answer(server.pageStatus, b'Service unavailable')
+                return
+            port = server.server_address[1]
+            body = ''.join('<span class="ga-download-resource-title" style="display: none">' + name + '</span>\n' for name in server.names)
+            body += ''.join('<a href="/download?url=' + urllib.parse.quote('http://127.0.0.1:%d/files/%s' % (port, name), safe='') + '&amp;x=1" class="btn">csv</a>\n' for name in server.names)
+            self.answer(200, body.encode())
+            return
+        filePath = os.path.join(server.folder, os.path.basename(path))
+        if not os.path.isfile(filePath):
+            self.answer(404, b'')
+            return
+        with open(filePath, 'rb') as infile:
+            content = infile.read()
+        etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+        if self.headers.get('If-None-Match') == etag:
+            self.answer(304, None, {'ETag' : etag})
+            return
+        rangeHeader = self.headers.get('Range')
+        if rangeHeader is not None and self.headers.get('If-Range') in (None, etag):
+            start = int(rangeHeader.split('=')[1].split('-')[0])
+            if start >= len(content):
+                self.answer(416, b'', {'Content-Range' : 'bytes */%d' % len(content)})
+                return
+            self.answer(206, content[start:], {'ETag' : etag, 'Content-Range' : 'bytes %d-%d/%d' % (start, len(content) - 1, len(content))})
+            return
+        self.answer(200, content, {'ETag' : etag, 'Accept-Ranges' : 'bytes'}, server.cutAfter)
+
+    def answer(self, status, body, headers={}, cutAfter=None):
+        # With cutAfter, the connection is closed after that many bytes of the body, as an interrupted download
+        self.server.requests.append((os.path.basename(urllib.parse.urlparse(self.path).path), status, self.headers.get('Range')))
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if body is not None:
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body if cutAfter is None else body[0:cutAfter])
+        if cutAfter is not None:
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        pass
+
+class StandInTestCase(unittest.TestCase):
+    nDays = 40
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.sourceDir = os.path.join(self.tmpDir, 'source')
+        self.served = os.path.join(self.tmpDir, 'served')
+        self.dataDir = os.path.join(self.tmpDir, 'data')
+        os.makedirs(self.served)
+        os.makedirs(self.dataDir)
+        self.sources = synth.write_hdx_csvs(self.sourceDir, 6, self.nDays)
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+        self.server.folder = self.served
+        self.server.names = [os.path.basename(path) for path in self.sources]
+        self.server.requests = []
+        self.server.pageStatus = 200
+        self.server.cutAfter = None
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.pageUrl = 'http://127.0.0.1:%d/page' % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.tmpDir, ignore_errors=True)
+
+    def serve(self, nDays, revise=None):
+        # Serving the first nDays of the synthetic files; revise=(row, day) changes one old value of the confirmed file
+        for path in self.sources:
+            table = pd.read_csv(path)
+            table = table.iloc[:, 0:len(dtmg.HDXcache.keyColumns) + nDays]
+            if revise is not None and 'confirmed' in os.path.basename(path):
+                row, day = revise
+                table.iloc[row, len(dtmg.HDXcache.keyColumns) + day] += 1
+            table.to_csv(os.path.join(self.served, os.path.basename(path)), index=False)
+
+    def hdx_data(self, useCache=True):
+        return dtmg.HDXdata(url=self.pageUrl, dataDir=self.dataDir, fetcher=dtmg.DataFetcher(workers=2, timeout=10), useCache=useCache)
+
+    def full_parse(self):
+        return dtmg.HDXdata([os.path.join(self.dataDir, name) for name in self.server.names], useCache=False).get_store()
+
+    def file_requests(self):
+        return [request for request in self.server.requests if request[0] in self.server.names]
+
+class TestConditionalDownload(StandInTestCase):
+    def test_unchanged_files_are_not_downloaded_again(self):
+        self.serve(self.nDays)
+        self.hdx_data().download()
+        self.server.requests.clear()
+        data = self.hdx_data()
+        data.download()
+        self.assertEqual(sorted(status for name, status, rangeHeader in self.file_requests()), [304, 304, 304])
+        self.assertEqual(len(data.get_store().dates), self.nDays)
+
+    def test_delta_append_matches_full_parse(self):
+        self.serve(self.nDays - 10)
+        self.hdx_data().get_store()
+        self.serve(self.nDays)
+        self.hdx_data().download(delta=True)
+        # The caches were extended with the new dates, so they are valid for the new files without parsing them
+        for name in self.server.names:
+            self.assertIsNotNone(dtmg.HDXcache(os.path.join(self.dataDir, name)).load())
+        store, reference = self.hdx_data().get_store(), self.full_parse()
+        self.assertEqual(list(store.dates), list(reference.dates))
+        self.assertEqual(len(store.dates), self.nDays)
+        np.testing.assert_array_equal(store.values, reference.values)
+
+    def test_revised_old_value_rebuilds_cache(self):
+        self.serve(self.nDays - 10)
+        self.hdx_data().get_store()
+        self.serve(self.nDays, revise=(2, 5))
+        self.hdx_data().download(delta=True)
+        confirmedName = [name for name in self.server.names if 'confirmed' in name][0]
+        self.assertIsNone(dtmg.HDXcache(os.path.join(self.dataDir, confirmedName)).load())
+        store, reference = self.hdx_data().get_store(), self.full_parse()
+        np.testing.assert_array_equal(store.values, reference.values)
+        revised = pd.read_csv(os.path.join(self.served, confirmedName)).iloc[2, len(dtmg.HDXcache.keyColumns) + 5]
+        self.assertEqual(store.values[2, 0, 5], revised)
+
+class TestDownloadFailures(StandInTestCase):
+    def test_unavailable_page_raises(self):
+        self.serve(self.nDays)
+        self.server.pageStatus = 503
+        with self.assertRaises(dtmg.DownloadError):
+            self.hdx_data().download()
+
+    def test_missing_file_without_previous_copy_raises(self):
+        self.serve(self.nDays)
+        os.remove(os.path.join(self.served, self.server.names[1]))
+        with self.assertRaises(dtmg.DownloadError):
+            self.hdx_data().download()
+
+    def test_missing_file_with_previous_copy_is_kept(self):
+        self.serve(self.nDays)
+        self.hdx_data().download()
+        os.remove(os.path.join(self.served, self.server.names[1]))
+        results = self.hdx_data().download()
+        self.assertIsNone(results[1])
+        self.assertTrue(os.path.isfile(os.path.join(self.dataDir, self.server.names[1])))
+
+    def test_fetch_sources_propagates_failures(self):
+        self.serve(self.nDays)
+        self.server.pageStatus = 503
+        popData = dtmg.POPdata(url='http://127.0.0.1:%d/files/WPP2019_TotalPopulationBySex.csv' % self.server.server_address[1],
+                               dataDir=self.dataDir, fetcher=dtmg.DataFetcher(timeout=10), load=False)
+        with self.assertRaises(dtmg.DownloadError):
+            dtmg.fetch_sources(self.hdx_data(), popData)
+
+class TestResumedDownload(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.serve(self.nDays)
+        self.name = self.server.names[0]
+        self.url = 'http://127.0.0.1:%d/files/%s' % (self.server.server_address[1], self.name)
+        self.path = os.path.join(self.dataDir, self.name)
+        with open(os.path.join(self.served, self.name), 'rb') as infile:
+            self.content = infile.read()
+
+    def test_interrupted_download_is_resumed_with_range(self):
+        fetcher = dtmg.DataFetcher(chunkSize=256, timeout=10)
+        self.server.cutAfter = len(self.content) // 2
+        self.assertIsNone(fetcher.fetch(self.url, self.path))
+        partSize = os.path.getsize(self.path + '.part')
+        self.assertGreater(partSize, 0)
+        self.assertIsNotNone(fetcher.read_state(self.path)['partial']['etag'])
+        self.server.cutAfter = None
+        self.server.requests.clear()
+        self.assertEqual(fetcher.fetch(self.url, self.path), 'downloaded')
+        self.assertEqual(self.file_requests(), [(self.name, 206, 'bytes=%d-' % partSize)])
+        with open(self.path, 'rb') as infile:
+            self.assertEqual(infile.read(), self.content)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.assertNotIn('partial', fetcher.read_state(self.path))
+
+    def test_complete_part_file_is_downloaded_again_after_416(self):
+        fetcher = dtmg.DataFetcher(timeout=10)
+        self.assertEqual(fetcher.fetch(self.url, self.path), 'downloaded')
+        # A complete part file left behind, as if the download stopped before replacing the file
+        os.replace(self.path, self.path + '.part')
+        fileState = fetcher.read_state(self.path)
+        fetcher.write_state(self.path, dict(fileState, partial={'etag' : fileState['etag'], 'lastModified' : None}))
+        self.server.requests.clear()
+        self.assertEqual(fetcher.fetch(self.url, self.path), 'downloaded')
+        self.assertEqual([status for name, status, rangeHeader in self.file_requests()], [416, 200])
+        with open(self.path, 'rb') as infile:
+            self.assertEqual(infile.read(), self.content)
+        self.assertFalse(os.path.exists(self.path + '.part'))
+        self.server.requests.clear()
+        self.assertEqual(fetcher.fetch(self.url, self.path), 'not-modified')
+        self.assertEqual(self.file_requests(), [(self.name, 304, None)])
+
+class TestServiceRefresh(StandInTestCase):
+    def setUp(self):
+        super().setUp()
+        self.serve(self.nDays)
+        self.hdx_data().download()
+        synth.write_wpp_csv(self.dataDir, self.hdx_data().get_store().countries)
+        self.service = forecast_service.ForecastService(self.dataDir, os.path.join(self.tmpDir, 'fits.json'), url=self.pageUrl)
+        self.httpServer = ThreadingHTTPServer(('127.0.0.1', 0), forecast_service.ForecastRequestHandler)
+        self.httpServer.service = self.service
+        threading.Thread(target=self.httpServer.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.httpServer.shutdown()
+        self.httpServer.server_close()
+        super().tearDown()
+
+    def post_refresh(self):
+        request = urllib.request.Request('http://127.0.0.1:%d/refresh' % self.httpServer.server_address[1], data=b'', method='POST')
+        try:
+            with urllib.request.urlopen(request, timeout=10) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as err:
+            return err.code, json.loads(err.read())
+
+    def test_refresh_swaps_the_data(self):
+        self.assertEqual(self.post_refresh(), (200, {'generation' : 1}))
+
+    def test_failed_refresh_answers_an_error_and_keeps_the_data(self):
+        data = self.service.data
+        self.server.pageStatus = 503
+        status, content = self.post_refresh()
+        self.assertEqual(status, 502)
+        self.assertIn('error', content)
+        self.assertIs(self.service.data, data)
+        self.assertEqual(self.service.generation, 0)
+        self.server.pageStatus = 200
+        os.remove(os.path.join(self.served, self.server.names[1]))
+        self.assertEqual(self.post_refresh()[0], 502)
+        self.assertIs(self.service.data, data)
+
+if __name__ == '__main__':
+    unittest.main()
\ No newline at end of file